@@ -9,10 +9,13 @@
 
 
 __version__ = "3.0.0"
+import os
 import re as _re
+import sys as _sys
 from argparse import SUPPRESS
 from argparse import ArgumentDefaultsHelpFormatter
 from argparse import HelpFormatter
+from argparse import _SubParsersAction
 
 
 try:
@@ -22,46 +25,875 @@ except ImportError:
 from argparse import ZERO_OR_MORE
 from argparse import RawDescriptionHelpFormatter
 from argparse import RawTextHelpFormatter
+from bisect import bisect_right as _bisect_right
+from collections import OrderedDict
+from copy import copy as _copy
 from gettext import gettext as _
+from html import escape as _html_escape
+from itertools import accumulate as _accumulate
 from textwrap import TextWrapper
-
-from colors import strip_color
+from threading import Lock
+from threading import get_ident
+from threading import local
+from time import perf_counter
+
+
+# CSI sequences (including SGR colours), OSC sequences (including OSC 8 hyperlinks)
+#  terminated by BEL or ST, and the remaining two character escapes.
+_escape_matcher = _re.compile(r"\x1b\[[0-?]*[ -/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)|\x1b[@-Z\\-_]")
+# the same, for text without BEL: OSC sequences can then only end with ST, and matching their text
+#  up to the next escape is faster than up to the next escape or BEL
+_st_escape_matcher = _re.compile(r"\x1b\[[0-?]*[ -/]*[@-~]|\x1b\][^\x1b]*\x1b\\|\x1b[@-Z\\-_]")
+
+
+def _escape_matcher_for(text):
+    return _escape_matcher if "\x07" in text else _st_escape_matcher
+
+
+def _escape_spans(text):
+    # the (start, end) of each escape sequence in text
+    if "\x1b" not in text:
+        return ()
+    return (match.span() for match in _escape_matcher_for(text).finditer(text))
+
+
+def _visible_width(text):
+    if "\x1b" not in text:
+        return len(text)
+    if isinstance(text, StyledStr):
+        return text.width
+    width = width_cache.get(text)
+    if width is None:
+        width = len(_escape_matcher_for(text).sub("", text))
+        width_cache.set(text, width)
+    return width
+
+
+def _chunk_width(chunk):
+    # the visible width of a chunk of text being wrapped; chunks are rarely measured twice, so
+    #  unlike _visible_width(), this doesn't fill width_cache with them
+    if "\x1b" not in chunk:
+        return len(chunk)
+    return len(_escape_matcher_for(chunk).sub("", chunk))
+
+
+# The wrappable parts of a usage string composed by HelpFormatter._format_actions_usage().
+_usage_part_matcher = _re.compile(r"\(.*?\)+(?=\s|$)|\[.*?\]+(?=\s|$)|\S+")
+
+
+def _split_usage(usage):
+    if not usage:
+        return []
+    parts = _usage_part_matcher.findall(usage)
+    # the parts only cover all of usage if they are separated by single spaces
+    assert sum(map(len, parts)) + len(parts) - 1 == len(usage)
+    return parts
+
+
+# Python 3.13 counts the indent of subactions, like the choices of subparsers, in the width of the
+#  action column
+_subaction_indent_counted = _sys.version_info >= (3, 13)
+
+# whitespace that TextWrapper expands or replaces
+_wrapped_whitespace_matcher = _re.compile(r"[\t\n\x0b\x0c\r]")
+# the whitespace HelpFormatter collapses before wrapping
+_whitespace_matcher = _re.compile(r"\s+", _re.ASCII)
+_space_chunk = (" ", 1)
+
+_sgr_reset = "\x1b[0m"
+_hyperlink_close = "\x1b]8;;\x1b\\"
+
+
+def _escape_state(escape, sgr, hyperlink):
+    # the SGR sequences and OSC 8 hyperlink active after escape
+    if escape.startswith("\x1b[") and escape.endswith("m"):
+        params = escape[2:-1]
+        if params in ("", "0"):
+            return "", hyperlink
+        if params.startswith("0;"):
+            return escape, hyperlink
+        return sgr + escape, hyperlink
+    if escape.startswith("\x1b]8;"):
+        uri = escape[4:].rstrip("\x07\x1b\\").partition(";")[2]
+        return sgr, escape if uri else ""
+    return sgr, hyperlink
+
+
+def _break_escaped_word(text, width, on_hyphens):
+    """Break text after at most width visible characters, as TextWrapper._handle_long_word() does.
+
+    Returns the head, the tail and the visible width of the head. Escape sequences just before the
+    break stay in the head, and the SGR attributes and OSC 8 hyperlink still active there are
+    closed at the end of the head and opened again at the start of the tail.
+    """
+    # (visible offset, index, active SGR sequences, active hyperlink) after each escape sequence
+    marks = [(0, 0, "", "")]
+    runs = []
+    visible = 0
+    pos = 0
+    sgr = ""
+    hyperlink = ""
+    for start, end in _escape_spans(text):
+        if visible + start - pos > width:
+            break
+        visible += start - pos
+        runs.append(text[pos:start])
+        sgr, hyperlink = _escape_state(text[start:end], sgr, hyperlink)
+        pos = end
+        marks.append((visible, pos, sgr, hyperlink))
+
+    # break after the last hyphen, but only if there are non-hyphens before it
+    head_width = width
+    if on_hyphens:
+        runs.append(text[pos : pos + width - visible])
+        visible_text = "".join(runs)
+        hyphen = visible_text.rfind("-", 0, width)
+        if hyphen > 0 and any(c != "-" for c in visible_text[:hyphen]):
+            head_width = hyphen + 1
+
+    visible, pos, sgr, hyperlink = next(mark for mark in reversed(marks) if mark[0] <= head_width)
+    cut = pos + head_width - visible
+    if cut >= len(text):
+        return text, "", visible + len(text) - pos
+    head = text[:cut]
+    if sgr:
+        head += _sgr_reset
+    if hyperlink:
+        head += _hyperlink_close
+    return head, hyperlink + sgr + text[cut:], head_width
+
+
+class StyledStr(str):
+    """A str with escape sequences in it, that carries its visible width.
+
+    The width is measured once, when it isn't given, and trusted from then on by this module, so
+    strings built with a known width are never scanned for escapes. Concatenating and joining
+    StyledStr add up their widths; slicing, % and format() return a StyledStr measured once.
+
+    Only a __dict__ holds the width, as str subclasses can't have non-empty __slots__.
+    """
+
+    def __new__(cls, text="", width=None):
+        self = super(StyledStr, cls).__new__(cls, text)
+        self.width = _visible_width(text) if width is None else width
+        return self
+
+    def __add__(self, other):
+        if not isinstance(other, str):
+            return NotImplemented
+        return StyledStr(str.__add__(self, other), self.width + _visible_width(other))
+
+    def __radd__(self, other):
+        if not isinstance(other, str):
+            return NotImplemented
+        return StyledStr(str.__add__(other, self), _visible_width(other) + self.width)
+
+    def __getitem__(self, key):
+        text = str.__getitem__(self, key)
+        if self.width == len(self):
+            # no escapes to slice through
+            return StyledStr(text, len(text))
+        return StyledStr(text)
+
+    def __mod__(self, args):
+        return StyledStr(str.__mod__(self, args))
+
+    def format(self, *args, **kwargs):
+        return StyledStr(str.format(self, *args, **kwargs))
+
+    def join(self, iterable):
+        parts = list(iterable)
+        text = str.join(self, parts)
+        return StyledStr(text, sum(map(_visible_width, parts)) + self.width * max(len(parts) - 1, 0))
+
+
+def styled(text, *codes):
+    """Return text in the SGR codes given, closed with a reset, as a StyledStr.
+
+    For example, styled("--output", 1, 31) is a bold red --output.
+    """
+    if not codes:
+        return StyledStr(text)
+    return StyledStr("\x1b[%sm%s\x1b[0m" % (";".join(map(str, codes)), text), _visible_width(text))
 
 
 def color_aware_pad(text, width, char=" "):
-    return text + char * (width - len(strip_color(text)))
+    return text + char * (width - _visible_width(text))
+
+
+def _strip_escapes(text):
+    if "\x1b" not in text:
+        return text
+    return _escape_matcher_for(text).sub("", text)
+
+
+def _is_blank_chunk(chunk):
+    # a chunk with no visible characters, or only whitespace ones
+    text, width = chunk
+    return not width or text.isspace()
+
+
+class _CacheStripe(object):
+    __slots__ = ("data", "lock", "maxsize", "hits", "misses", "evictions")
+
+    def __init__(self, maxsize):
+        # key -> [value, read since it was last passed over for eviction]
+        self.data = {}
+        self.lock = Lock()
+        self.maxsize = maxsize
+        self.hits = self.misses = self.evictions = 0
+
+    def evict(self):
+        # the oldest entry that wasn't read since it was last passed over is evicted; one that was
+        #  gets a second chance, at the end, so this approximates least recently used.
+        data = self.data
+        while len(data) > self.maxsize:
+            key = next(iter(data))
+            entry = data.pop(key)
+            if entry[1]:
+                entry[1] = False
+                data[key] = entry
+            else:
+                self.evictions += 1
+
+
+class _LRUCache(object):
+    """An approximately least recently used cache, that can be shared between threads.
+
+    Reads take no lock, so they never wait on each other or on writes, and only mark the entry they
+    found as recently used. Entries are spread over stripes by the hash of their key, each with its
+    own lock for writes. The hit and miss counts aren't locked, so they're approximate when threads
+    share the cache.
+    """
+
+    def __init__(self, maxsize=128, stripes=None):
+        if maxsize < 1:
+            raise ValueError("invalid maxsize %r (must be > 0)" % maxsize)
+        if stripes is None:
+            # small caches get a single stripe, so their evictions follow the order of all entries
+            stripes = min(16, max(1, maxsize // 64))
+        self._stripes = tuple(_CacheStripe(0) for _ in range(stripes))
+        self._resize_stripes(maxsize)
+
+    @property
+    def maxsize(self):
+        return sum([stripe.maxsize for stripe in self._stripes])
+
+    def _resize_stripes(self, maxsize):
+        size, extra = divmod(maxsize, len(self._stripes))
+        for i, stripe in enumerate(self._stripes):
+            stripe.maxsize = size + (i < extra)
+
+    def _stripe(self, key):
+        stripes = self._stripes
+        if len(stripes) == 1:
+            return stripes[0]
+        return stripes[hash(key) % len(stripes)]
+
+    def __len__(self):
+        return sum([len(stripe.data) for stripe in self._stripes])
+
+    def get(self, key, default=None):
+        stripe = self._stripe(key)
+        entry = stripe.data.get(key)
+        if entry is None:
+            stripe.misses += 1
+            return default
+        entry[1] = True
+        stripe.hits += 1
+        return entry[0]
+
+    def set(self, key, value):
+        stripe = self._stripe(key)
+        with stripe.lock:
+            entry = stripe.data.get(key)
+            if entry is None:
+                stripe.data[key] = [value, False]
+                stripe.evict()
+            else:
+                entry[0] = value
+                entry[1] = True
+
+    def resize(self, maxsize):
+        """Keep at most maxsize entries from now on, evicting the least recently used ones over it."""
+        if maxsize < 1:
+            raise ValueError("invalid maxsize %r (must be > 0)" % maxsize)
+        self._resize_stripes(maxsize)
+        for stripe in self._stripes:
+            with stripe.lock:
+                stripe.evict()
+
+    def stats(self):
+        """Return the hits, misses and evictions since the last clear(), and the size and maxsize."""
+        stripes = self._stripes
+        return {
+            "hits": sum([stripe.hits for stripe in stripes]),
+            "misses": sum([stripe.misses for stripe in stripes]),
+            "evictions": sum([stripe.evictions for stripe in stripes]),
+            "size": len(self),
+            "maxsize": self.maxsize,
+        }
+
+    def clear(self):
+        """Remove all entries, and reset the stats."""
+        for stripe in self._stripes:
+            with stripe.lock:
+                stripe.data.clear()
+                stripe.hits = stripe.misses = stripe.evictions = 0
+
+
+class HelpCache(_LRUCache):
+    """Rendered help and usage, keyed by a fingerprint of the parser and formatter.
+
+    Assign an instance to the help_cache attribute of a Color*HelpFormatter subclass. At most
+    maxsize renders are kept, evicting about the least recently used first. One instance can be
+    shared by formatters rendering in many threads; reads never block.
+    """
+
+
+class WidthCache(_LRUCache):
+    """Visible widths of strings with escape sequences, so strings measured again aren't rescanned.
+
+    The module's width_cache is the one used while formatting, by every thread, for the strings
+    measured on every render, like prog, prefixes and invocations, but not the words of wrapped
+    text. At most maxsize widths are kept, evicting about the least recently used first; resize()
+    changes maxsize.
+    """
+
+
+width_cache = WidthCache(maxsize=1024)
+
+
+class HelpSnapshot(object):
+    """Rendered help and usage kept in files under directory, so later runs can skip formatting.
+
+    Assign an instance to the help_cache attribute of a Color*HelpFormatter subclass. Each render
+    is stored in its own file, named after a digest of the formatter's fingerprint and this
+    package's version; files are replaced atomically, so concurrent runs never read a partial one.
+    """
+
+    suffix = ".help"
+
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+
+    def _path(self, key):
+        # imported here, as a snapshot hit is meant to avoid as much start up work as possible
+        from hashlib import sha256
+
+        digest = sha256(repr((__version__, key)).encode("utf-8", "surrogatepass")).hexdigest()
+        return os.path.join(self.directory, digest + self.suffix)
+
+    def get(self, key, default=None):
+        try:
+            with open(self._path(key), encoding="utf-8", newline="") as snapshot:
+                version, _, value = snapshot.read().partition("\n")
+        except (OSError, UnicodeError):
+            return default
+        if version != __version__:
+            return default
+        return value
+
+    def set(self, key, value):
+        path = self._path(key)
+        temp_path = "%s.%d.%d.tmp" % (path, os.getpid(), get_ident())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp_path, "w", encoding="utf-8", newline="") as snapshot:
+                snapshot.write("%s\n%s" % (__version__, value))
+            os.replace(temp_path, path)
+        except (OSError, UnicodeError):
+            # failing to save a snapshot shouldn't stop the help from being shown
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+
+    def clear(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.endswith(self.suffix):
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+
+# the address in the default repr of objects, like <object object at 0x7f...>
+_address_matcher = _re.compile(r" at 0x[0-9A-Fa-f]+")
+
+
+def _fingerprint_text(value, text):
+    # text, the repr or str of value, unless it has an address in it, which changes from run to run;
+    #  then the str, which is what %(default)s shows, or only the type if that has an address too
+    if not _address_matcher.search(text):
+        return text
+    name = "%s.%s" % (type(value).__module__, type(value).__qualname__)
+    text = str(value)
+    if _address_matcher.search(text):
+        return name
+    return (name, text)
+
+
+# lists, tuples, dicts and sets with more items than this are fingerprinted by a digest of their items,
+#  so a large default doesn't make every cache key hold a copy of it
+_fingerprint_max_items = 64
+
+
+def _fingerprint_items(value):
+    from hashlib import sha256
+
+    if isinstance(value, dict):
+        value = value.items()
+    texts = (repr(_fingerprint_value(item)) for item in value)
+    if isinstance(value, (set, frozenset)):
+        # sorted, as their order depends on PYTHONHASHSEED
+        texts = sorted(texts)
+    digest = sha256()
+    for text in texts:
+        digest.update(text.encode("utf-8", "surrogatepass"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _fingerprint_value(value):
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    if isinstance(value, (list, tuple, dict, set, frozenset)) and len(value) > _fingerprint_max_items:
+        return ("%s.%s" % (type(value).__module__, type(value).__qualname__), len(value), _fingerprint_items(value))
+    if isinstance(value, (list, tuple)):
+        return tuple(_fingerprint_value(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        # sorted, as their order depends on PYTHONHASHSEED
+        return (type(value).__name__,) + tuple(sorted(repr(_fingerprint_value(item)) for item in value))
+    if callable(value) and hasattr(value, "__qualname__"):
+        # the repr of most callables includes their address
+        return "%s.%s" % (getattr(value, "__module__", None), value.__qualname__)
+    return _fingerprint_text(value, repr(value))
+
+
+def _fingerprint_choices(choices):
+    # choices are shown by their str()
+    if choices is None:
+        return None
+    names = tuple(_fingerprint_text(choice, str(choice)) for choice in choices)
+    if isinstance(choices, (set, frozenset)):
+        return tuple(sorted(names))
+    return names
+
+
+def _fingerprint_action(action, fingerprints):
+    # fingerprints holds those of the actions already fingerprinted, as usage and the sections
+    #  hold the same actions
+    fingerprint = fingerprints.get(action)
+    if fingerprint is None:
+        fingerprint = fingerprints[action] = _fingerprint_new_action(action, fingerprints)
+    return fingerprint
+
+
+def _fingerprint_new_action(action, fingerprints):
+    return (
+        "%s.%s" % (type(action).__module__, type(action).__qualname__),
+        tuple(action.option_strings),
+        action.dest,
+        _fingerprint_value(action.nargs),
+        _fingerprint_value(action.const),
+        _fingerprint_value(action.default),
+        _fingerprint_value(action.type),
+        _fingerprint_choices(action.choices),
+        action.required,
+        _fingerprint_value(action.help),
+        _fingerprint_value(action.metavar),
+        tuple(_fingerprint_action(subaction, fingerprints) for subaction in getattr(action, "_get_subactions", list)()),
+    )
+
+
+def _fingerprint_group(group, fingerprints):
+    return (group.required, tuple(_fingerprint_action(action, fingerprints) for action in group._group_actions))
+
+
+_color_modes = ("always", "auto", "never")
+
+
+def _colors_wanted(color_mode, file):
+    # whether help written to file, or anywhere when it's None, should keep its colors
+    if color_mode not in _color_modes:
+        raise ValueError("invalid color_mode %r (must be one of %s)" % (color_mode, ", ".join(map(repr, _color_modes))))
+    if color_mode != "auto":
+        return color_mode == "always"
+    if os.environ.get("NO_COLOR"):
+        return False
+    if os.environ.get("FORCE_COLOR"):
+        return True
+    if os.environ.get("TERM") == "dumb":
+        return False
+    if file is None:
+        return True
+    try:
+        return file.isatty()
+    except (AttributeError, ValueError):
+        # not a file, or a closed one
+        return False
 
 
 class ColorHelpFormatterMixin(object):
+    # set to a HelpCache to reuse rendered help and usage while the parser and width are unchanged
+    help_cache = None
+    # "always" keeps the colors of the help; "never" strips them, as "auto" does when NO_COLOR is
+    #  set or stdout isn't a terminal. Texts are stripped as they're added, so none are measured
+    #  for escapes.
+    color_mode = "always"
+    # set by HelpLayout to the layout whose measured words, expanded help and usage parts to reuse
+    _layout = None
+
+    def __init__(self, *args, **kwargs):
+        super(ColorHelpFormatterMixin, self).__init__(*args, **kwargs)
+        # action -> (invocation, visible width of invocation)
+        self._invocation_cache = {}
+        # (action, indent) added while a help_cache is set, measured only when rendering
+        self._deferred_actions = []
+        # (width, indent) -> ColorTextWrapper
+        self._wrappers = {}
+        # action or group -> the copy of it without escapes, or itself when it has none
+        self._stripped = {}
+        self._colored_prog = self._prog
+        self._set_destination(_sys.stdout)
+
+    def _set_destination(self, file):
+        # decide whether to keep the colors of help written to file, or of help that is translated
+        #  when it's None. Without them, the escapes are stripped from every text as it's added.
+        self._monochrome = not _colors_wanted(self.color_mode, file)
+        self._prog = _strip_escapes(self._colored_prog) if self._monochrome else self._colored_prog
+        color = getattr(self, "_theme_color", None)
+        if color is not None:
+            self._set_color(color)
+
+    def _set_color(self, color):
+        # the stdlib's own colors, where it has them, are only used with those of the help
+        self._theme_color = color
+        return super(ColorHelpFormatterMixin, self)._set_color(color and not getattr(self, "_monochrome", False))
+
+    def _stripped_action(self, action):
+        # action, or a copy of it with the escapes stripped from what the help shows of it
+        stripped = self._stripped.get(action)
+        if stripped is not None:
+            return stripped
+        subactions = getattr(action, "_choices_actions", None)
+        stripped_subactions = None if subactions is None else [self._stripped_action(sub) for sub in subactions]
+        metavar = action.metavar
+        texts = list(action.option_strings) + [action.dest, action.help]
+        texts += metavar if isinstance(metavar, tuple) else [metavar]
+        stripped = action
+        if stripped_subactions != subactions or any(isinstance(text, str) and "\x1b" in text for text in texts):
+            stripped = _copy(action)
+            stripped.option_strings = [_strip_escapes(text) for text in action.option_strings]
+            for name in ("dest", "help", "metavar"):
+                value = getattr(action, name)
+                if isinstance(value, str):
+                    setattr(stripped, name, _strip_escapes(value))
+                elif isinstance(value, tuple):
+                    setattr(stripped, name, tuple(_strip_escapes(text) for text in value))
+            if subactions is not None:
+                stripped._choices_actions = stripped_subactions
+        self._stripped[action] = stripped
+        return stripped
+
+    def _stripped_group(self, group):
+        # group, or a copy of it holding the stripped copies of its actions
+        stripped = self._stripped.get(group)
+        if stripped is None:
+            stripped = group
+            group_actions = [self._stripped_action(action) for action in group._group_actions]
+            if group_actions != group._group_actions:
+                stripped = _copy(group)
+                stripped._group_actions = group_actions
+            self._stripped[group] = stripped
+        return stripped
+
+    def start_section(self, heading):
+        if self._monochrome and isinstance(heading, str):
+            heading = _strip_escapes(heading)
+        super(ColorHelpFormatterMixin, self).start_section(heading)
+
+    def add_text(self, text):
+        if self._monochrome and isinstance(text, str):
+            text = _strip_escapes(text)
+        super(ColorHelpFormatterMixin, self).add_text(text)
+
+    def add_usage(self, usage, actions, groups, prefix=None):
+        if self._monochrome:
+            if isinstance(usage, str):
+                usage = _strip_escapes(usage)
+            if isinstance(prefix, str):
+                prefix = _strip_escapes(prefix)
+            actions = [self._stripped_action(action) for action in actions]
+            groups = [self._stripped_group(group) for group in groups]
+        super(ColorHelpFormatterMixin, self).add_usage(usage, actions, groups, prefix)
+
     def _fill_text(self, text, width, indent):
-        text = self._whitespace_matcher.sub(" ", text).strip()
-        return ColorTextWrapper(width=width, initial_indent=indent, subsequent_indent=indent).fill(text)
+        wrapper = self._get_wrapper(width, indent)
+        if isinstance(text, StyledStr) and self._layout is None:
+            # a StyledStr that fits on a line isn't split at all
+            return wrapper.fill(self._collapse_whitespace(text))
+        return "\n".join(self._wrap_collapsed(text, wrapper))
 
     def _split_lines(self, text, width):
-        text = self._whitespace_matcher.sub(" ", text).strip()
-        return ColorTextWrapper(width=width).wrap(text)
+        wrapper = self._get_wrapper(width, "")
+        if isinstance(text, StyledStr) and self._layout is None:
+            return wrapper.wrap(self._collapse_whitespace(text))
+        return self._wrap_collapsed(text, wrapper)
+
+    def _get_wrapper(self, width, indent):
+        # wrapping leaves no state in a wrapper, so the texts of every action share a few of them
+        key = (width, indent)
+        wrapper = self._wrappers.get(key)
+        if wrapper is None:
+            wrapper = ColorTextWrapper(width=width, initial_indent=indent, subsequent_indent=indent)
+            self._wrappers[key] = wrapper
+        return wrapper
+
+    def _wrap_collapsed(self, text, wrapper):
+        # the lines of text with its whitespace collapsed. A layout keeps the chunks of each text
+        #  from its first render, with their texts and the running totals of their widths, so
+        #  later ones only look up where each line breaks.
+        if self._layout is None:
+            return wrapper._wrap_measured_chunks(wrapper._split_collapsed_chunks(text))
+        entry = self._layout._chunks.get(text)
+        if entry is None:
+            chunks = wrapper._split_collapsed_chunks(text)
+            offsets = list(_accumulate([width for _, width in chunks], initial=0))
+            entry = self._layout._chunks[text] = (chunks, [chunk for chunk, _ in chunks], offsets)
+        chunks, texts, offsets = entry
+        lines = wrapper._break_measured_chunks(chunks, texts, offsets)
+        if lines is None:
+            # wrapping consumes the list
+            lines = wrapper._wrap_measured_chunks(list(chunks))
+        return lines
+
+    def _expand_help(self, action):
+        if self._layout is None:
+            return self._expand_stripped_help(action)
+        help_texts = self._layout._help_texts
+        key = (action, self._monochrome)
+        if key not in help_texts:
+            help_texts[key] = self._expand_stripped_help(action)
+        return help_texts[key]
+
+    def _expand_stripped_help(self, action):
+        help_text = self._expand_action_help(action)
+        if self._monochrome:
+            # the default, choices and the like can have escapes too
+            return _strip_escapes(help_text)
+        return help_text
+
+    def _expand_action_help(self, action):
+        return super(ColorHelpFormatterMixin, self)._expand_help(action)
+
+    def _collapse_whitespace(self, text):
+        collapsed = self._whitespace_matcher.sub(" ", text).strip()
+        # a StyledStr that was already collapsed keeps its width
+        if isinstance(text, StyledStr) and collapsed == text:
+            return text
+        return collapsed
+
+    def _get_invocation(self, action):
+        # add_argument and _format_action both need the invocations of every action and subaction,
+        #  so format and measure each of them only once per formatter.
+        try:
+            return self._invocation_cache[action]
+        except KeyError:
+            invocation = super(ColorHelpFormatterMixin, self)._format_action_invocation(action)
+            entry = self._invocation_cache[action] = (invocation, self._invocation_width(action, invocation))
+            return entry
+
+    def _invocation_width(self, action, invocation):
+        if "\x1b" not in invocation:
+            return len(invocation)
+        # when all the escapes come from StyledStr metavars, their widths are known
+        metavars = action.metavar if isinstance(action.metavar, tuple) else (action.metavar,)
+        escapes = invocation.count("\x1b")
+        escapes_len = 0
+        for metavar in metavars:
+            if isinstance(metavar, StyledStr) and metavar.width != len(metavar):
+                count = invocation.count(metavar)
+                escapes -= count * metavar.count("\x1b")
+                escapes_len += count * (len(metavar) - metavar.width)
+        if escapes:
+            return _visible_width(invocation)
+        return len(invocation) - escapes_len
+
+    def _format_action_invocation(self, action):
+        return self._get_invocation(action)[0]
 
     def add_argument(self, action):
-        old_max = self._action_max_length
-        super(ColorHelpFormatterMixin, self).add_argument(action)
-        # the self._action_max_length updated above won't account for color codes,
-        #  so we need to update it here as well
-        if action.help is not SUPPRESS:
-            self._action_max_length = old_max
-            get_invocation = self._format_action_invocation
-            invocations = [get_invocation(action)]
-            for subaction in self._iter_indented_subactions(action):
-                invocations.append(get_invocation(subaction))
-
-            invocation_length = max(len(strip_color(invocation)) for invocation in invocations)
-            action_length = invocation_length + self._current_indent
-            self._action_max_length = max(self._action_max_length, action_length)
+        # HelpFormatter.add_argument(), but with the visible widths of invocations
+        if action.help is SUPPRESS:
+            return
+        if self._monochrome:
+            action = self._stripped_action(action)
+        if self.help_cache is not None:
+            # with a cache, invocations are only measured by format_help, if the help isn't cached
+            self._deferred_actions.append((action, self._current_indent))
+        else:
+            self._fit_action(action, self._current_indent)
+        self._add_item(self._format_action, [action])
+
+    def _fit_action(self, action, indent):
+        # widen _action_max_length to fit the invocations of action and its subactions, a running
+        #  max over invocations measured once per formatter
+        get_invocation = self._get_invocation
+        max_length = max(self._action_max_length, get_invocation(action)[1] + indent)
+        if _subaction_indent_counted:
+            indent += self._indent_increment
+        for subaction in self._iter_indented_subactions(action):
+            length = get_invocation(subaction)[1] + indent
+            if length > max_length:
+                max_length = length
+        self._action_max_length = max_length
+
+    def format_help(self):
+        if self._monochrome:
+            # one last pass, for escapes added while formatting, like by overridden methods
+            return _strip_escapes(self._format_help())
+        return self._format_help()
+
+    def _format_help(self):
+        if self.help_cache is None:
+            return super(ColorHelpFormatterMixin, self).format_help()
+        key = self._help_fingerprint()
+        help_text = self.help_cache.get(key)
+        if help_text is None:
+            for action, indent in self._deferred_actions:
+                self._fit_action(action, indent)
+            help_text = super(ColorHelpFormatterMixin, self).format_help()
+            self.help_cache.set(key, help_text)
+        return help_text
+
+    def iter_help(self):
+        """Yield the lines of format_help(), each one as soon as it has been formatted."""
+        if self._monochrome:
+            return map(_strip_escapes, self._iter_help())
+        return self._iter_help()
+
+    def _iter_help(self):
+        if self.help_cache is not None:
+            # rendered help is only cached as a whole
+            yield from self.format_help().splitlines(True)
+            return
+
+        # the same as format_help(), collapsing runs of blank lines to one, and dropping leading and
+        #  trailing ones, but for a line at a time.
+        line_start = ""
+        blank_lines = 0
+        started = False
+        has_text = False
+        for part in self._iter_section_parts(self._root_section):
+            has_text = True
+            *lines, line_start = (line_start + part).split("\n")
+            for line in lines:
+                if not line:
+                    blank_lines += started
+                    continue
+                if blank_lines:
+                    yield "\n"
+                    blank_lines = 0
+                started = True
+                yield line + "\n"
+        if line_start:
+            if blank_lines:
+                yield "\n"
+            yield line_start + "\n"
+        elif has_text and not started:
+            yield "\n"
+
+    def _streams_actions(self):
+        # subclasses that override _format_action get it called for every action
+        return type(self)._format_action is ColorHelpFormatterMixin._format_action
+
+    def _iter_section_parts(self, section):
+        # section.format_help(), yielding the parts of each item instead of joining them
+        if section.parent is not None:
+            self._indent()
+            heading = self._format_heading(section.heading, self._current_indent - self._indent_increment)
+        else:
+            heading = self._format_heading(section.heading, self._current_indent)
+        streams_actions = self._streams_actions()
+        started = False
+        for func, args in section.items:
+            owner = getattr(func, "__self__", None)
+            if isinstance(owner, self._Section):
+                parts = self._iter_section_parts(owner)
+            elif streams_actions and func.__name__ == "_format_action":
+                parts = self._iter_action_parts(*args)
+            else:
+                parts = (func(*args),)
+            for part in parts:
+                if not part or part is SUPPRESS:
+                    continue
+                if not started:
+                    started = True
+                    yield "\n"
+                    yield heading
+                yield part
+        if section.parent is not None:
+            self._dedent()
+        if started:
+            yield "\n"
+
+    def _format_heading(self, heading, indent):
+        if heading is SUPPRESS or heading is None:
+            return ""
+        heading_text = _("%(heading)s:") % {"heading": heading}
+        theme = getattr(self, "_theme", None)
+        if theme is None:
+            return "%*s%s\n" % (indent, "", heading_text)
+        return f"{' ' * indent}{theme.heading}{heading_text}{theme.reset}\n"
+
+    def _help_fingerprint(self):
+        """Return a hashable description of everything format_help() output depends on."""
+        theme = getattr(self, "_theme", None)
+        return (
+            "%s.%s" % (type(self).__module__, type(self).__qualname__),
+            self._prog,
+            self._width,
+            self._max_help_position,
+            self._indent_increment,
+            self._monochrome,
+            None if theme is None else repr(theme),
+            self._fingerprint_section(self._root_section, {}),
+        )
+
+    def _fingerprint_section(self, section, fingerprints):
+        items = []
+        for func, args in section.items:
+            owner = getattr(func, "__self__", None)
+            if isinstance(owner, self._Section):
+                items.append((owner.heading, self._fingerprint_section(owner, fingerprints)))
+            elif func.__name__ == "_format_usage":
+                usage, actions, groups, prefix = args
+                items.append(
+                    (
+                        func.__name__,
+                        usage,
+                        tuple(_fingerprint_action(action, fingerprints) for action in actions),
+                        tuple(_fingerprint_group(group, fingerprints) for group in groups),
+                        prefix,
+                    )
+                )
+            elif func.__name__ == "_format_action":
+                items.append((func.__name__, _fingerprint_action(args[0], fingerprints)))
+            else:
+                items.append((func.__name__,) + _fingerprint_value(args))
+        return tuple(items)
 
     def _format_args(self, action, default_metavar):
         result = super()._format_args(action, default_metavar)
         if action.nargs == ZERO_OR_MORE:
             metavar = self._metavar_formatter(action, default_metavar)(1)
-            if len(strip_color(metavar)) == 2:
+            if len(metavar) == 2:
                 result = "[%s [%s ...]]" % metavar
             else:
                 result = "[%s ...]" % metavar
@@ -70,12 +902,16 @@ class ColorHelpFormatterMixin(object):
     # modified upstream code
     # fmt: off
     def _format_action(self, action):
+        # return a single string
+        return self._join_parts(self._iter_action_parts(action))
+
+    def _iter_action_parts(self, action):
         # determine the required width and the entry label
         help_position = min(self._action_max_length + 2,
                             self._max_help_position)
         help_width = max(self._width - help_position, 11)
         action_width = help_position - self._current_indent - 2
-        action_header = self._format_action_invocation(action)
+        action_header, action_header_width = self._get_invocation(action)
 
         # no help; start on same line and add a final newline
         if not action.help:
@@ -83,8 +919,9 @@ class ColorHelpFormatterMixin(object):
             action_header = '%*s%s\n' % tup
 
         # short action name; start on the same line and pad two spaces
-        elif len(strip_color(action_header)) <= action_width:
-            tup = self._current_indent, '', color_aware_pad(action_header, action_width)
+        elif action_header_width <= action_width:
+            padding = ' ' * (action_width - action_header_width)
+            tup = self._current_indent, '', action_header + padding
             action_header = '%*s%s  ' % tup
             indent_first = 0
 
@@ -94,38 +931,120 @@ class ColorHelpFormatterMixin(object):
             action_header = '%*s%s\n' % tup
             indent_first = help_position
 
-        # collect the pieces of the action help
-        parts = [action_header]
+        # yield the pieces of the action help
+        yield action_header
 
         # if there was help for the action, add lines of help text
         if action.help and action.help.strip():
             help_text = self._expand_help(action)
             if help_text:
                 help_lines = self._split_lines(help_text, help_width)
-                parts.append('%*s%s\n' % (indent_first, '', help_lines[0]))
+                yield '%*s%s\n' % (indent_first, '', help_lines[0])
                 for line in help_lines[1:]:
-                    parts.append('%*s%s\n' % (help_position, '', line))
+                    yield '%*s%s\n' % (help_position, '', line)
 
         # or add a newline if the description doesn't end with one
         elif not action_header.endswith('\n'):
-            parts.append('\n')
+            yield '\n'
 
         # if there are any sub-actions, add their help as well
+        streams_actions = self._streams_actions()
         for subaction in self._iter_indented_subactions(action):
-            parts.append(self._format_action(subaction))
-
-        # return a single string
-        return self._join_parts(parts)
+            if streams_actions:
+                yield from self._iter_action_parts(subaction)
+            else:
+                yield self._format_action(subaction)
     # fmt: on
 
     # modified upstream code, not going to refactor for complexity.
+    def _get_usage_parts(self, actions, groups):
+        """Return the usage parts of the optionals and of the positionals, as (part, width) records.
+
+        The third item is the usage of all the actions, when a mutually exclusive group has both
+        optionals and positionals, and so it differs from the parts joined with spaces.
+        """
+        if self._layout is not None:
+            key = (tuple(actions), tuple(groups))
+            usage_parts = self._layout._usage_parts
+            if key not in usage_parts:
+                usage_parts[key] = self._measure_usage_parts(actions, groups)
+            opt_parts, pos_parts, action_usage = usage_parts[key]
+            return list(opt_parts), list(pos_parts), action_usage
+        return self._measure_usage_parts(actions, groups)
+
+    def _measure_usage_parts(self, actions, groups):
+        # Python 3.14 removed _format_actions_usage and changed the
+        # return value of _get_actions_usage_parts. Python 3.13 exposes
+        # both methods, including the older return value.
+        compose = getattr(self, "_format_actions_usage", None)
+        if compose is None:
+            parts, pos_start = self._get_actions_usage_parts(actions, groups)
+            parts = [(part, _visible_width(part)) for part in parts]
+            return parts[:pos_start], parts[pos_start:], None
+
+        # split optionals from positionals
+        optionals = []
+        positionals = []
+        for action in actions:
+            if action.option_strings:
+                optionals.append(action)
+            else:
+                positionals.append(action)
+
+        # composing each half once gives both the parts and, joined, the usage,
+        #  unless a group spans the two halves.
+        action_usage = None
+        for group in groups:
+            if len({not action.option_strings for action in group._group_actions}) > 1:
+                action_usage = compose(optionals + positionals, groups)
+                break
+
+        if type(self)._format_actions_usage is HelpFormatter._format_actions_usage and hasattr(
+            self, "_get_actions_usage_parts"
+        ):
+            # Python 3.13 returns the parts as a list
+            opt_parts = self._get_actions_usage_parts(optionals, groups)
+            pos_parts = self._get_actions_usage_parts(positionals, groups)
+        else:
+            opt_parts = _split_usage(compose(optionals, groups))
+            pos_parts = _split_usage(compose(positionals, groups))
+        opt_parts = [(part, _visible_width(part)) for part in opt_parts]
+        pos_parts = [(part, _visible_width(part)) for part in pos_parts]
+        return opt_parts, pos_parts, action_usage
+
+    def _get_usage_lines(self, parts, indent, text_width, line=None, line_len=None):
+        """Wrap (part, width) records into lines that fit text_width, each starting with indent.
+
+        A first line that already holds parts is passed as line, with its width so far as line_len,
+        and is not indented.
+        """
+        lines = []
+        indent_length = len(indent)
+        if line is None:
+            line = []
+            line_len = indent_length - 1
+            line_indent = indent
+        else:
+            line_indent = ""
+        for part, part_len in parts:
+            if line_len + 1 + part_len > text_width and line:
+                lines.append(line_indent + " ".join(line))
+                line = []
+                line_len = indent_length - 1
+                line_indent = indent
+            line.append(part)
+            line_len += part_len + 1
+        if line:
+            lines.append(line_indent + " ".join(line))
+        return lines
+
     # fmt: off
     def _format_usage(self, usage, actions, groups, prefix):  # noqa: C901
         theme = getattr(self, "_theme", None)
 
         if prefix is None:
             prefix = _("usage: ")
-        prefix_len = len(strip_color(prefix))
+        prefix_len = _visible_width(prefix)
 
         # if usage is specified, use that
         if usage is not None:
@@ -149,92 +1068,51 @@ class ColorHelpFormatterMixin(object):
         # if optionals and positionals are available, calculate usage
         elif usage is None:
             prog = "%(prog)s" % {"prog": self._prog}
-
-            # Python 3.14 removed _format_actions_usage and changed the
-            # return value of _get_actions_usage_parts. Python 3.13 exposes
-            # both methods, including the older return value.
-            compose = getattr(self, "_format_actions_usage", None)
-            if compose is None:
-                parts, pos_start = self._get_actions_usage_parts(actions, groups)
-                opt_parts = parts[:pos_start]
-                pos_parts = parts[pos_start:]
-                action_usage = " ".join(parts)
+            len_prog = _visible_width(prog)
+
+            # the usage parts of optionals and positionals, as (part, width)
+            opt_parts, pos_parts, action_usage = self._get_usage_parts(actions, groups)
+            parts = opt_parts + pos_parts
+            parts_len = sum([part_len for _, part_len in parts]) + len(parts) - 1
+            if action_usage is None:
+                action_usage = " ".join([part for part, _ in parts])
+                usage_len = parts_len
             else:
-                # split optionals from positionals
-                optionals = []
-                positionals = []
-                for action in actions:
-                    if action.option_strings:
-                        optionals.append(action)
-                    else:
-                        positionals.append(action)
-
-                action_usage = compose(optionals + positionals, groups)
-
-            usage = " ".join([s for s in [prog, action_usage] if s])
+                usage_len = _visible_width(action_usage)
+            if not action_usage:
+                usage = prog
+                usage_len = len_prog
+            elif prog:
+                usage = prog + " " + action_usage
+                usage_len += len_prog + 1
+            else:
+                usage = action_usage
 
             # wrap the usage parts if it's too long
             text_width = self._width - self._current_indent
-            if prefix_len + len(strip_color(usage)) > text_width:
-
-                if compose is not None:
-                    # break usage into wrappable parts
-                    part_regexp = (
-                        r'\(.*?\)+(?=\s|$)|'
-                        r'\[.*?\]+(?=\s|$)|'
-                        r'\S+'
-                    )
-                    opt_usage = compose(optionals, groups)
-                    pos_usage = compose(positionals, groups)
-                    opt_parts = _re.findall(part_regexp, opt_usage)
-                    pos_parts = _re.findall(part_regexp, pos_usage)
-                    assert " ".join(opt_parts) == opt_usage
-                    assert " ".join(pos_parts) == pos_usage
-
-                # helper for wrapping lines
-                def get_lines(parts, indent, prefix=None):
-                    lines = []
-                    line = []
-                    indent_length = len(indent)
-                    if prefix is not None:
-                        line_len = prefix_len - 1
-                    else:
-                        line_len = indent_length - 1
-                    for part in parts:
-                        part_len = len(strip_color(part))
-                        if line_len + 1 + part_len > text_width and line:
-                            lines.append(indent + " ".join(line))
-                            line = []
-                            line_len = indent_length - 1
-                        line.append(part)
-                        line_len += part_len + 1
-                    if line:
-                        lines.append(indent + " ".join(line))
-                    if prefix is not None:
-                        lines[0] = lines[0][indent_length:]
-                    return lines
+            if prefix_len + usage_len > text_width:
+                get_lines = self._get_usage_lines
 
                 # if prog is short, follow it with optionals or positionals
-                len_prog = len(strip_color(prog))
                 if prefix_len + len_prog <= 0.75 * text_width:
                     indent = " " * (prefix_len + len_prog + 1)
                     if opt_parts:
-                        lines = get_lines([prog] + opt_parts, indent, prefix)
-                        lines.extend(get_lines(pos_parts, indent))
+                        lines = get_lines(opt_parts, indent, text_width, [prog], prefix_len + len_prog)
+                        lines.extend(get_lines(pos_parts, indent, text_width))
                     elif pos_parts:
-                        lines = get_lines([prog] + pos_parts, indent, prefix)
+                        lines = get_lines(pos_parts, indent, text_width, [prog], prefix_len + len_prog)
                     else:
                         lines = [prog]
 
-                # if prog is long, put it on its own line
+                # if prog is long, put it on its own line, followed by the parts on one line if they
+                #  fit, and otherwise the optionals and positionals on lines of their own
                 else:
                     indent = " " * prefix_len
-                    parts = opt_parts + pos_parts
-                    lines = get_lines(parts, indent)
-                    if len(lines) > 1:
-                        lines = []
-                        lines.extend(get_lines(opt_parts, indent))
-                        lines.extend(get_lines(pos_parts, indent))
+                    if len(parts) < 2 or prefix_len + parts_len <= text_width:
+                        lines = get_lines(parts, indent, text_width)
+                    else:
+                        lines = get_lines(opt_parts, indent, text_width)
+                        lines.extend(get_lines(pos_parts, indent, text_width))
                     lines = [prog] + lines
 
                 # join lines into usage
@@ -255,11 +1133,925 @@ class ColorHelpFormatter(ColorHelpFormatterMixin, HelpFormatter):
     pass
 
 
+def _add_parser_help(parser, formatter):
+    # the same items ArgumentParser.format_help() adds
+    formatter.add_usage(parser.usage, parser._actions, parser._mutually_exclusive_groups)
+    formatter.add_text(parser.description)
+    for action_group in parser._action_groups:
+        formatter.start_section(action_group.title)
+        formatter.add_text(action_group.description)
+        formatter.add_arguments(action_group._group_actions)
+        formatter.end_section()
+    formatter.add_text(parser.epilog)
+
+
+class HelpLayout(object):
+    """The help of a parser, split into measured words once, to lay out again at any width.
+
+    The first render adds the parser's help to a formatter and keeps it, with the invocations,
+    expanded help, usage parts and measured words of every text, so later renders, like redraws
+    after a terminal is resized, only break lines::
+
+        layout = HelpLayout(parser)
+        layout.format_help(78)
+
+    Make a new layout, or clear() this one, after changing the parser.
+    """
+
+    def __init__(self, parser, formatter_class=None):
+        self.parser = parser
+        self.formatter_class = parser.formatter_class if formatter_class is None else formatter_class
+        # action -> (invocation, visible width of invocation)
+        self._invocations = {}
+        # (action, monochrome) -> expanded help
+        self._help_texts = {}
+        # text -> [(chunk, visible width)] of the text with its whitespace collapsed
+        self._chunks = {}
+        # (actions, groups) -> the records of _get_usage_parts()
+        self._usage_parts = {}
+        # (width, indent) -> ColorTextWrapper
+        self._wrappers = {}
+        # action or group -> the copy of it without escapes, or itself when it has none
+        self._stripped = {}
+        # the formatters holding the help and the usage, laid out again at each width
+        self._help_formatter = None
+        self._usage_formatter = None
+        # the max_help_position the formatters were made with
+        self._max_help_position = None
+
+    def _formatter(self):
+        # made by the parser, so overrides of _get_formatter(), and the parser's color on Python
+        #  3.14, are kept
+        parser = self.parser
+        if self.formatter_class is not parser.formatter_class:
+            parser = _copy(parser)
+            parser.formatter_class = self.formatter_class
+        formatter = parser._get_formatter()
+        if isinstance(formatter, ColorHelpFormatterMixin):
+            formatter._layout = self
+            formatter._invocation_cache = self._invocations
+            formatter._wrappers = self._wrappers
+            formatter._stripped = self._stripped
+        if self._max_help_position is None:
+            # HelpFormatter.__init__() caps it to fit the width it was made with
+            if formatter._max_help_position < max(formatter._width - 20, formatter._indent_increment * 2):
+                self._max_help_position = formatter._max_help_position
+            else:
+                self._max_help_position = self.formatter_class(prog=parser.prog, width=10**6)._max_help_position
+        return formatter
+
+    def _set_width(self, formatter, width):
+        # the same as HelpFormatter.__init__()
+        if width is None:
+            import shutil
+
+            width = shutil.get_terminal_size().columns - 2
+        formatter._width = width
+        formatter._max_help_position = min(self._max_help_position, max(width - 20, formatter._indent_increment * 2))
+        return formatter
+
+    def format_help(self, width=None):
+        """Return the help laid out width columns wide, by default the width of the terminal less 2."""
+        formatter = self._help_formatter
+        if formatter is None:
+            formatter = self._help_formatter = self._formatter()
+            _add_parser_help(self.parser, formatter)
+        return self._set_width(formatter, width).format_help()
+
+    def format_usage(self, width=None):
+        """Return the usage laid out width columns wide, like format_help()."""
+        formatter = self._usage_formatter
+        if formatter is None:
+            parser = self.parser
+            formatter = self._usage_formatter = self._formatter()
+            formatter.add_usage(parser.usage, parser._actions, parser._mutually_exclusive_groups)
+        return self._set_width(formatter, width).format_help()
+
+    def clear(self):
+        """Forget everything kept from earlier renders."""
+        self._invocations.clear()
+        self._help_texts.clear()
+        self._chunks.clear()
+        self._usage_parts.clear()
+        self._wrappers.clear()
+        self._stripped.clear()
+        self._help_formatter = None
+        self._usage_formatter = None
+        self._max_help_position = None
+
+
+def print_help(parser, file=None, render=None):
+    """Write the help of parser to file, stdout by default, a line at a time as it is formatted.
+
+    render translates the lines on the way, like iter_html or iter_markdown. Parsers whose
+    formatter_class isn't one of the Color* formatters are formatted with parser.format_help().
+    """
+    if file is None:
+        file = _sys.stdout
+    formatter = parser._get_formatter()
+    if isinstance(formatter, ColorHelpFormatterMixin):
+        # with a renderer, colors are translated instead of written to file
+        formatter._set_destination(None if render else file)
+        _add_parser_help(parser, formatter)
+        lines = formatter.iter_help()
+    elif render is None:
+        parser.print_help(file)
+        return
+    else:
+        lines = parser.format_help().splitlines(True)
+    write = getattr(file, "write", None)
+    if write is None:
+        return
+    if render is not None:
+        lines = render(lines)
+    for line in lines:
+        try:
+            write(line)
+        except OSError:
+            return
+
+
+# the 16 colours of SGR 30-37 and 90-97 (and 40-47, 100-107), as xterm shows them
+_ansi_palette = (
+    "#000000",
+    "#cd0000",
+    "#00cd00",
+    "#cdcd00",
+    "#0000ee",
+    "#cd00cd",
+    "#00cdcd",
+    "#e5e5e5",
+    "#7f7f7f",
+    "#ff0000",
+    "#00ff00",
+    "#ffff00",
+    "#5c5cff",
+    "#ff00ff",
+    "#00ffff",
+    "#ffffff",
+)
+_sgr_attributes = {1: "bold", 2: "dim", 3: "italic", 4: "underline", 9: "strike"}
+_sgr_attribute_resets = {22: ("bold", "dim"), 23: ("italic",), 24: ("underline",), 29: ("strike",)}
+
+
+def _indexed_color(index):
+    # the colours of 38;5;n and 48;5;n
+    if index < 16:
+        return _ansi_palette[index]
+    if index < 232:
+        index -= 16
+        levels = [0 if level == 0 else 55 + 40 * level for level in (index // 36, index // 6 % 6, index % 6)]
+        return "#{:02x}{:02x}{:02x}".format(*levels)
+    level = 8 + 10 * (index - 232)
+    return "#{0:02x}{0:02x}{0:02x}".format(level)
+
+
+def _extended_color(params):
+    # the colour of the parameters after a 38 or 48, and how many of them it used
+    try:
+        if params[0] == 5:
+            return _indexed_color(params[1] % 256), 2
+        if params[0] == 2:
+            return "#{:02x}{:02x}{:02x}".format(*(min(255, param) for param in params[1:4])), 4
+    except (IndexError, ValueError):
+        pass
+    return None, len(params)
+
+
+def _basic_color(param):
+    # the style key and colour set by one of SGR 30-37, 40-47, 90-97 and 100-107, or None
+    for key, first in (("fg", 30), ("bg", 40)):
+        if first <= param < first + 8:
+            return key, _ansi_palette[param - first]
+        if first + 60 <= param < first + 68:
+            return key, _ansi_palette[param - first - 52]
+    return None
+
+
+def _sgr_style(escape, style):
+    # the style, as a dict of attributes to True and of fg and bg to colours, after an SGR sequence
+    params = [int(param) if param.isdigit() else 0 for param in escape[2:-1].replace(":", ";").split(";")]
+    style = dict(style)
+    i = 0
+    while i < len(params):
+        param = params[i]
+        i += 1
+        basic_color = _basic_color(param)
+        if param == 0:
+            style.clear()
+        elif param in _sgr_attributes:
+            style[_sgr_attributes[param]] = True
+        elif param in _sgr_attribute_resets:
+            for attribute in _sgr_attribute_resets[param]:
+                style.pop(attribute, None)
+        elif basic_color is not None:
+            style[basic_color[0]] = basic_color[1]
+        elif param in (38, 48):
+            color, used = _extended_color(params[i:])
+            i += used
+            if color is not None:
+                style["fg" if param == 38 else "bg"] = color
+        elif param in (39, 49):
+            style.pop("fg" if param == 39 else "bg", None)
+    return style
+
+
+_html_declarations = (("bold", "font-weight:bold"), ("dim", "opacity:0.5"), ("italic", "font-style:italic"))
+_html_decorations = (("underline", "underline"), ("strike", "line-through"))
+
+
+def _html_tags(style, uri):
+    tags = []
+    if uri:
+        tags.append(('<a href="%s">' % _html_escape(uri), "</a>"))
+    declarations = [declaration for attribute, declaration in _html_declarations if attribute in style]
+    decorations = [decoration for attribute, decoration in _html_decorations if attribute in style]
+    if decorations:
+        declarations.append("text-decoration:" + " ".join(decorations))
+    if "fg" in style:
+        declarations.append("color:" + style["fg"])
+    if "bg" in style:
+        declarations.append("background-color:" + style["bg"])
+    if declarations:
+        tags.append(('<span style="%s">' % ";".join(declarations), "</span>"))
+    return tags
+
+
+def _markdown_tags(style, uri):
+    # only the tags markdown renderers keep in raw html; colours are dropped
+    tags = []
+    if uri:
+        tags.append(('<a href="%s">' % _html_escape(uri), "</a>"))
+    for attribute, tag in (("bold", "b"), ("italic", "i"), ("underline", "ins"), ("strike", "del")):
+        if attribute in style:
+            tags.append(("<%s>" % tag, "</%s>" % tag))
+    return tags
+
+
+def _markup_line(text, style, uri, tags_for):
+    # text, without its line ending, with its escape sequences translated to the tags returned by
+    #  tags_for(style, uri), and the style and uri at the end of it. tags are closed at the end of
+    #  the line, so every line is well formed on its own.
+    parts = []
+    tags = None
+    position = 0
+    for start, end in _escape_spans(text):
+        if start > position:
+            if tags is None:
+                tags = tags_for(style, uri)
+                parts.extend(opening for opening, _ in tags)
+            parts.append(_html_escape(text[position:start], quote=False))
+        position = end
+        escape = text[start:end]
+        if escape.startswith("\x1b[") and escape.endswith("m"):
+            new_style, new_uri = _sgr_style(escape, style), uri
+        elif escape.startswith("\x1b]8;"):
+            new_style, new_uri = style, escape[4:].rstrip("\x07\x1b\\").partition(";")[2]
+        else:
+            continue
+        if tags is not None and (new_style, new_uri) != (style, uri):
+            parts.extend(closing for _, closing in reversed(tags))
+            tags = None
+        style, uri = new_style, new_uri
+    if position < len(text):
+        if tags is None:
+            tags = tags_for(style, uri)
+            parts.extend(opening for opening, _ in tags)
+        parts.append(_html_escape(text[position:], quote=False))
+    if tags is not None:
+        parts.extend(closing for _, closing in reversed(tags))
+    return "".join(parts), style, uri
+
+
+def _iter_markup(lines, tags_for):
+    # the lines in a <pre> element, translated by _markup_line() a line at a time
+    style = {}
+    uri = ""
+    yield "<pre>\n"
+    for chunk in lines:
+        for line in chunk.splitlines(True):
+            text = line.rstrip("\r\n")
+            markup, style, uri = _markup_line(text, style, uri, tags_for)
+            yield markup + line[len(text) :]
+    yield "</pre>\n"
+
+
+def iter_html(lines):
+    """Translate lines of colored help, like those of formatter.iter_help(), to HTML, a line at a time.
+
+    Yields a <pre> element: colors and text styles become spans with inline styles, and OSC 8
+    hyperlinks become links. The text is kept as it is, so it lines up as it does in a terminal.
+    """
+    return _iter_markup(lines, _html_tags)
+
+
+def iter_markdown(lines):
+    """Translate lines of colored help to Markdown, a line at a time, like iter_html().
+
+    Markdown has no colors, so the lines are kept in a <pre> block of the raw html tags markdown
+    renderers keep: <b>, <i>, <ins>, <del> and links.
+    """
+    return _iter_markup(lines, _markdown_tags)
+
+
+def _iter_subparsers(parser, path=(), seen=None):
+    # (path, parser) of parser and every subparser reachable from it, depth first in the order they
+    #  were added, each parser only once in the whole tree, under its first name and parent
+    if seen is None:
+        seen = {id(parser)}
+    yield path, parser
+    for action in parser._actions:
+        if isinstance(action, _SubParsersAction):
+            for name, subparser in action.choices.items():
+                if id(subparser) not in seen:
+                    seen.add(id(subparser))
+                    yield from _iter_subparsers(subparser, path + (name,), seen)
+
+
+def _find_subparser(parser, path):
+    for name in path:
+        parser = next(action for action in parser._actions if isinstance(action, _SubParsersAction)).choices[name]
+    return parser
+
+
+def _render_help(parser, formatter_class, width):
+    formatter = formatter_class(prog=parser.prog, width=width)
+    _add_parser_help(parser, formatter)
+    return formatter.format_help()
+
+
+_export_root = None
+
+
+def _start_export_worker(parser_factory):
+    global _export_root
+    _export_root = parser_factory()
+
+
+def _export_node(path, formatter_class, widths):
+    # [(help, seconds)] of the subparser at path, at each width
+    parser = _find_subparser(_export_root, path)
+    rendered = []
+    for width in widths:
+        start = perf_counter()
+        help_text = _render_help(parser, formatter_class, width)
+        rendered.append((help_text, perf_counter() - start))
+    return rendered
+
+
+def _export_name(path, width):
+    from urllib.parse import quote
+
+    if not path:
+        return "%d.txt" % width
+    return "%d/%s.txt" % (width, "/".join([quote(name, safe="") for name in path]))
+
+
+def export_help(parser_factory, destination, widths=(80,), formatter_class=None, processes=None):
+    """Render the help of a parser and of every subparser under it, at each width, in a process pool.
+
+    parser_factory is called once in each worker process to build the root parser, so it has to be
+    picklable, like a function defined at the top level of a module. The help of the parser at
+    path (a, b) and width 80 is written to 80/a/b.txt under the destination directory, or in the
+    zip archive if destination ends with .zip; the root's is 80.txt. Nodes are rendered with
+    formatter_class, ColorHelpFormatter by default. processes is the size of the pool, the number
+    of CPUs by default; 1 renders in this process.
+
+    Files are written in the same order each time, so archives of the same help are identical.
+    Returns a record of each node at each width, in that order: its path, prog, width, file name,
+    and the seconds spent rendering it.
+    """
+    if formatter_class is None:
+        formatter_class = ColorHelpFormatter
+    widths = tuple(widths)
+    nodes = list(_iter_subparsers(parser_factory()))
+    paths = [path for path, _ in nodes]
+
+    if processes == 1:
+        _start_export_worker(parser_factory)
+        rendered = [_export_node(path, formatter_class, widths) for path in paths]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        processes = processes or os.cpu_count() or 1
+        chunksize = max(1, len(paths) // (4 * processes))
+        with ProcessPoolExecutor(processes, initializer=_start_export_worker, initargs=(parser_factory,)) as pool:
+            rendered = list(
+                pool.map(
+                    _export_node,
+                    paths,
+                    [formatter_class] * len(paths),
+                    [widths] * len(paths),
+                    chunksize=chunksize,
+                )
+            )
+
+    records = []
+    files = []
+    for (path, parser), node_help in zip(nodes, rendered):
+        for width, (help_text, seconds) in zip(widths, node_help):
+            name = _export_name(path, width)
+            files.append((name, help_text))
+            records.append({"path": path, "prog": parser.prog, "width": width, "file": name, "seconds": seconds})
+
+    if destination.endswith(".zip"):
+        import zipfile
+
+        with zipfile.ZipFile(destination, "w", zipfile.ZIP_DEFLATED) as archive:
+            for name, help_text in files:
+                # a ZipInfo brings its own compress_type, which isn't the archive's
+                info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+                archive.writestr(info, help_text.encode("utf-8"), compress_type=zipfile.ZIP_DEFLATED)
+    else:
+        for name, help_text in files:
+            file_path = os.path.join(destination, *name.split("/"))
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "w", encoding="utf-8") as help_file:
+                help_file.write(help_text)
+    return records
+
+
+def _iter_subclasses(cls):
+    # every subclass of cls, not only the direct ones, each once
+    seen = set()
+    pending = list(cls.__subclasses__())
+    while pending:
+        subclass = pending.pop(0)
+        if subclass not in seen:
+            seen.add(subclass)
+            yield subclass
+            pending.extend(subclass.__subclasses__())
+
+
+class _ProfileState(local):
+    def __init__(self):
+        # the stages being timed in this thread, and the [record, seconds spent in nested actions]
+        #  of the actions it is formatting
+        self.timing = set()
+        self.actions = []
+
+
+def _counted(chunks, record):
+    # the chunks, counted in the record as they are taken
+    for chunk in chunks:
+        record["chunks"] += 1
+        yield chunk
+
+
+class FormattingProfile(object):
+    """Calls to, and time spent in, the stages of formatting help and usage, while in a with block.
+
+    Entering the block replaces the stages of every Color* formatter class, subclasses included,
+    with counting and timing versions, in every thread, and leaving it puts the originals back, so
+    nothing is added to formatting outside of it; only one profile can be in a with block at a time.
+    Each thread's calls are timed on their own, and added up::
+
+        with FormattingProfile() as profile:
+            parser.format_help()
+        profile.summary()  # {"_format_usage": {"calls": 1, "seconds": 0.0004}, ...}
+
+    The time of a stage includes that of the stages it calls; "_visible_width" and "_chunk_width"
+    are the numbers of width measurements, of the strings measured on every render and of the
+    chunks of wrapped text.
+
+    With actions=True, the time spent formatting each action, including expanding its help, and the
+    number of chunks and lines of its help, are recorded as well, for action_report().
+    """
+
+    formatter_stages = ("_format_usage", "_format_action", "_expand_help", "_split_lines", "_fill_text")
+    wrapper_stages = ("_wrap_measured_chunks",)
+    function_stages = ("_visible_width", "_chunk_width")
+
+    # the profile in a with block, if any
+    _active = None
+    _active_lock = Lock()
+
+    def __init__(self, actions=False):
+        # stage -> [calls, seconds]
+        self._stats = OrderedDict(
+            (stage, [0, 0.0]) for stage in self.formatter_stages + self.wrapper_stages + self.function_stages
+        )
+        self._replaced = []
+        self.actions = actions
+        # action -> record
+        self._action_records = OrderedDict()
+        self._state = _ProfileState()
+
+    def __enter__(self):
+        with FormattingProfile._active_lock:
+            if FormattingProfile._active is not None:
+                # profiles replace the same stages, and one leaving before another would keep its
+                #  replacements in place, or take away the other's
+                raise RuntimeError("another FormattingProfile is already active")
+            FormattingProfile._active = self
+        formatter_classes = [ColorHelpFormatterMixin] + list(_iter_subclasses(ColorHelpFormatterMixin))
+        for owner, stages in [(cls, self.formatter_stages) for cls in formatter_classes] + [
+            (ColorTextWrapper, self.wrapper_stages)
+        ]:
+            for stage in stages:
+                if stage in vars(owner):
+                    self._replace(owner, stage, self._profiled(vars(owner)[stage], stage))
+        module = _sys.modules[__name__]
+        for stage in self.function_stages:
+            self._replace(module, stage, self._profiled(getattr(module, stage), stage))
+        if self.actions:
+            self._replace(
+                ColorHelpFormatterMixin,
+                "_iter_action_parts",
+                self._traced_parts(ColorHelpFormatterMixin._iter_action_parts),
+            )
+            for owner in formatter_classes:
+                if "_expand_help" in vars(owner):
+                    self._replace(owner, "_expand_help", self._traced_expand_help(vars(owner)["_expand_help"]))
+                if "_split_lines" in vars(owner):
+                    self._replace(owner, "_split_lines", self._traced_split_lines(vars(owner)["_split_lines"]))
+            self._replace(
+                ColorTextWrapper,
+                "_wrap_measured_chunks",
+                self._traced_wrap_measured_chunks(ColorTextWrapper._wrap_measured_chunks),
+            )
+        return self
+
+    def __exit__(self, *exc_info):
+        while self._replaced:
+            owner, name, original = self._replaced.pop()
+            setattr(owner, name, original)
+        FormattingProfile._active = None
+
+    def _replace(self, owner, name, replacement):
+        self._replaced.append((owner, name, vars(owner)[name]))
+        setattr(owner, name, replacement)
+
+    def _profiled(self, func, stage):
+        stats = self._stats[stage]
+        state = self._state
+
+        def profiled(*args, **kwargs):
+            stats[0] += 1
+            timing = state.timing
+            if stage in timing:
+                # a stage calling itself, already being timed
+                return func(*args, **kwargs)
+            timing.add(stage)
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats[1] += perf_counter() - start
+                timing.discard(stage)
+
+        return profiled
+
+    def _traced_parts(self, iter_action_parts):
+        records = self._action_records
+        state = self._state
+
+        def traced_parts(formatter, action):
+            active = state.actions
+            record = records.get(action)
+            if record is None:
+                record = records[action] = {
+                    "action": _strip_escapes(formatter._get_invocation(action)[0]),
+                    "renders": 0,
+                    "seconds": 0.0,
+                    "expand_help_seconds": 0.0,
+                    "chunks": 0,
+                    "lines": 0,
+                }
+            record["renders"] += 1
+            parts = iter_action_parts(formatter, action)
+            while True:
+                # only the time spent producing this action's own parts, not those of its subactions
+                entry = [record, 0.0]
+                active.append(entry)
+                start = perf_counter()
+                try:
+                    part = next(parts)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed = perf_counter() - start
+                    active.pop()
+                    record["seconds"] += elapsed - entry[1]
+                    if active:
+                        active[-1][1] += elapsed
+                yield part
+
+        return traced_parts
+
+    def _traced_expand_help(self, expand_help):
+        state = self._state
+
+        def traced_expand_help(formatter, action):
+            active = state.actions
+            start = perf_counter()
+            try:
+                return expand_help(formatter, action)
+            finally:
+                if active:
+                    active[-1][0]["expand_help_seconds"] += perf_counter() - start
+
+        return traced_expand_help
+
+    def _traced_split_lines(self, split_lines):
+        state = self._state
+
+        def traced_split_lines(formatter, text, width):
+            active = state.actions
+            lines = split_lines(formatter, text, width)
+            if active:
+                active[-1][0]["lines"] += len(lines)
+            return lines
+
+        return traced_split_lines
+
+    def _traced_wrap_measured_chunks(self, wrap_measured_chunks):
+        state = self._state
+
+        def traced_wrap_measured_chunks(wrapper, chunks):
+            active = state.actions
+            if active:
+                # the chunks the help is wrapped from, as they were split, so help wrapped some other
+                #  way, as ColorRawTextHelpFormatter does, has none
+                record = active[-1][0]
+                if isinstance(chunks, _ChunkStream):
+                    chunks._chunks = _counted(chunks._chunks, record)
+                else:
+                    record["chunks"] += len(chunks)
+            return wrap_measured_chunks(wrapper, chunks)
+
+        return traced_wrap_measured_chunks
+
+    def action_report(self, sort_by="seconds"):
+        """Return the record of each action formatted with actions=True, the largest sort_by first.
+
+        Records are dicts of the action's invocation, the number of times it was formatted, the
+        seconds spent formatting it, not including its subactions, and expanding its help, and the
+        number of chunks and lines its help was wrapped from and into.
+        """
+        return sorted(
+            [dict(record) for record in self._action_records.values()], key=lambda record: record[sort_by], reverse=True
+        )
+
+    def summary(self):
+        """Return {stage: {"calls": int, "seconds": float}}, in the order stages are formatted."""
+        return OrderedDict(
+            (stage, {"calls": calls, "seconds": seconds}) for stage, (calls, seconds) in self._stats.items()
+        )
+
+    def dump(self, file=None, **kwargs):
+        """Write summary() to file as JSON, or return it as a JSON string if file is None.
+
+        Keyword arguments are passed on to json.dump().
+        """
+        return self._dump(self.summary(), file, kwargs)
+
+    def dump_action_report(self, file=None, sort_by="seconds", **kwargs):
+        """Write action_report(sort_by) to file as JSON, or return it as a JSON string if file is None."""
+        return self._dump(self.action_report(sort_by), file, kwargs)
+
+    @staticmethod
+    def _dump(data, file, kwargs):
+        import json
+
+        if file is None:
+            return json.dumps(data, **kwargs)
+        json.dump(data, file, **kwargs)
+
+
+def _iter_split(regex, text):
+    # regex.split(text), without the empty strings, a piece at a time
+    position = 0
+    for match in regex.finditer(text):
+        start, end = match.span()
+        if start > position:
+            yield text[position:start]
+        for group in match.groups():
+            if group:
+                yield group
+        position = end
+    if position < len(text):
+        yield text[position:]
+
+
+class _ChunkStream(object):
+    """Measured chunks taken from an iterator only as they are needed.
+
+    Works as the reversed list of chunks _wrap_measured_chunks() pops from: the next chunk is
+    chunks[-1], and can be replaced, deleted or popped.
+    """
+
+    __slots__ = ("_chunks", "_stack")
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        # chunks taken from the iterator and not yet wrapped, the next one last
+        self._stack = []
+
+    def peek(self, count):
+        """Return the next count chunks, in order, or as many as are left."""
+        stack = self._stack
+        while len(stack) < count:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            stack.insert(0, chunk)
+        return stack[: -count - 1 : -1]
+
+    def __bool__(self):
+        return bool(self._stack or self.peek(1))
+
+    def __getitem__(self, index):
+        if not self._stack:
+            self.peek(1)
+        return self._stack[index]
+
+    def __setitem__(self, index, chunk):
+        self._stack[index] = chunk
+
+    def __delitem__(self, index):
+        del self._stack[index]
+
+    def pop(self):
+        if not self._stack:
+            self.peek(1)
+        return self._stack.pop()
+
+
 class ColorTextWrapper(TextWrapper):
+    def wrap(self, text):
+        if isinstance(text, StyledStr) and self._fits_on_a_line(text):
+            return [self.initial_indent + text]
+        if self.max_lines is not None:
+            # wrapping stops at max_lines, so only split and measure the chunks it gets to
+            return self._wrap_measured_chunks(_ChunkStream(self._iter_measured_chunks(text)))
+        return self._wrap_measured_chunks(self._split_measured_chunks(text))
+
+    def _fits_on_a_line(self, text):
+        # whether wrapping would return text as is, on the first line, going by its known width
+        return (
+            0 < text.width <= self.width - len(self.initial_indent)
+            and self.max_lines is None
+            and not self.fix_sentence_endings
+            # the last chunk, dropped if it is blank: whitespace, or only escape sequences
+            and not (self.drop_whitespace and not _chunk_width(text.rpartition(" ")[2]))
+            and not _wrapped_whitespace_matcher.search(text)
+        )
+
+    def _split_measured_chunks(self, text):
+        """_split_measured_chunks(text : string) -> [(string, int)]
+
+        Split the text into chunks as _split_chunks() does, and pair each
+        chunk with its visible width, so it only has to be measured once.
+        """
+        chunks = self._split_chunks(text)
+        if self.fix_sentence_endings:
+            self._fix_sentence_endings(chunks)
+        return [(chunk, _chunk_width(chunk)) for chunk in chunks]
+
+    def _iter_measured_chunks(self, text):
+        """Yield the chunks of _split_measured_chunks(text) one at a time, each one split from the
+        text and measured only when it is taken."""
+        if type(self)._split_chunks is not TextWrapper._split_chunks or type(self)._split is not TextWrapper._split:
+            yield from self._split_measured_chunks(text)
+            return
+        wordsep_re = self.wordsep_re if self.break_on_hyphens is True else self.wordsep_simple_re
+        sentence_end = self.sentence_end_re.search
+        previous = ""
+        for chunk in _iter_split(wordsep_re, self._munge_whitespace(text)):
+            # the same as _fix_sentence_endings()
+            if self.fix_sentence_endings and chunk == " " and sentence_end(previous):
+                chunk = "  "
+            previous = chunk
+            yield chunk, _chunk_width(chunk)
+
+    def _split_collapsed_chunks(self, text):
+        """Collapse the whitespace of text as HelpFormatter does, then split and measure it as
+        _split_measured_chunks() would.
+
+        Collapsed text is words between single spaces, and only words with hyphens can be split
+        any further, so the words are split off with str.split() and the word separator regex
+        only runs on those, each chunk measured as it is split.
+        """
+        text = _whitespace_matcher.sub(" ", text).strip()
+        if (
+            type(self)._split_chunks is not TextWrapper._split_chunks
+            or type(self)._split is not TextWrapper._split
+            or self.wordsep_re is not TextWrapper.wordsep_re
+            or self.fix_sentence_endings
+        ):
+            return self._split_measured_chunks(text)
+        if not text:
+            return []
+        words = text.split(" ")
+        hyphens = self.break_on_hyphens is True and "-" in text
+        if not hyphens and "\x1b" not in text:
+            chunks = [_space_chunk] * (2 * len(words) - 1)
+            chunks[::2] = [(word, len(word)) for word in words]
+            return chunks
+        chunks = []
+        append = chunks.append
+        split = self.wordsep_re.split
+        for word in words:
+            if hyphens and "-" in word:
+                for piece in split(word):
+                    if piece:
+                        append((piece, _chunk_width(piece)))
+            else:
+                append((word, _chunk_width(word)))
+            append(_space_chunk)
+        chunks.pop()
+        return chunks
+
+    def _wrap_chunks(self, chunks):
+        return self._wrap_measured_chunks([(chunk, _chunk_width(chunk)) for chunk in chunks])
+
+    def _break_measured_chunks(self, chunks, texts, offsets):
+        """Return the lines _wrap_measured_chunks(chunks) would, or None if a chunk is too wide for
+        a line, or max_lines is set, when it has to be wrapped by _wrap_measured_chunks() instead.
+
+        texts are the texts of the chunks, and offsets the running totals of their widths, from 0,
+        so the end of each line is found by a binary search, without going through its chunks.
+        """
+        if self.max_lines is not None:
+            return None
+        lines = []
+        count = len(chunks)
+        start = 0
+        while start < count:
+            if lines:
+                indent = self.subsequent_indent
+            else:
+                indent = self.initial_indent
+            width = self.width - len(indent)
+            if width < 1:
+                return None
+            # the first chunk on a line, if it is whitespace, is dropped, unless it starts the text
+            if self.drop_whitespace and lines and _is_blank_chunk(chunks[start]):
+                start += 1
+                if start == count:
+                    break
+            end = _bisect_right(offsets, offsets[start] + width, start) - 1
+            if end < count and chunks[end][1] > width:
+                return None
+            last = end
+            if self.drop_whitespace and _is_blank_chunk(chunks[last - 1]):
+                last -= 1
+            if last > start:
+                lines.append(indent + "".join(texts[start:last]))
+            start = end
+        return lines
+
+    def _handle_long_measured_word(self, reversed_chunks, cur_line, cur_len, width):
+        """Apply _handle_long_word() to a stack of measured chunks, and return the new cur_len.
+
+        A word with escape sequences is broken after a visible character, never inside a sequence,
+        and the colours and hyperlink active at the break are closed before it and reopened after.
+        """
+        chunk, chunk_width = reversed_chunks[-1]
+        if "\x1b" not in chunk:
+            word_chunks = [chunk]
+            word_line = [text for text, _ in cur_line]
+            self._handle_long_word(word_chunks, word_line, cur_len, width)
+            for text in word_line[len(cur_line) :]:
+                cur_line.append((text, len(text)))
+                cur_len += len(text)
+            if word_chunks:
+                reversed_chunks[-1] = (word_chunks[-1], len(word_chunks[-1]))
+            else:
+                del reversed_chunks[-1]
+            return cur_len
+
+        # the same as _handle_long_word(), but on visible characters
+        if width < 1:
+            space_left = 1
+        else:
+            space_left = width - cur_len
+
+        # a chunk of only escape sequences is only too long when the indent is, and can't be broken
+        if self.break_long_words and chunk_width:
+            head, tail, head_width = _break_escaped_word(
+                chunk, space_left, self.break_on_hyphens and chunk_width > space_left
+            )
+            cur_line.append((head, head_width))
+            reversed_chunks[-1] = (tail, chunk_width - head_width)
+            return cur_len + head_width
+
+        elif not cur_line:
+            cur_line.append(reversed_chunks.pop())
+            return cur_len + chunk_width
+
+        return cur_len
+
+    def _only_blank_left(self, chunks):
+        # whether no chunks are left to wrap, or only whitespace that would be dropped
+        upcoming = chunks.peek(2) if isinstance(chunks, _ChunkStream) else chunks[-1:-3:-1]
+        return not upcoming or self.drop_whitespace and len(upcoming) == 1 and not upcoming[0][0].strip()
+
     # modified upstream code, not going to refactor for complexity.
     # fmt: off
-    def _wrap_chunks(self, chunks):  # noqa: C901
-        """_wrap_chunks(chunks : [string]) -> [string]
+    def _wrap_measured_chunks(self, chunks):  # noqa: C901
+        """_wrap_measured_chunks(chunks : [(string, int)]) -> [string]
 
         Wrap a sequence of text chunks and return a list of lines of
         length 'self.width' or less.  (If 'break_long_words' is false,
@@ -270,6 +2062,11 @@ class ColorTextWrapper(TextWrapper):
         whitespace; ie. a chunk is either all whitespace or a "word".
         Whitespace chunks will be removed from the beginning and end of
         lines, but apart from that whitespace is preserved.
+
+        Each chunk is a (text, width) pair, where width is the visible
+        width of text, so no chunk is measured again while wrapping.
+        Chunks can also be given as a _ChunkStream, which is only read
+        up to the last line when max_lines is set.
         """
         lines = []
         if self.width <= 0:
@@ -284,12 +2081,13 @@ class ColorTextWrapper(TextWrapper):
 
         # Arrange in reverse order so items can be efficiently popped
         # from a stack of chucks.
-        chunks.reverse()
+        if not isinstance(chunks, _ChunkStream):
+            chunks.reverse()
 
         while chunks:
 
             # Start the list of chunks that will make up the current line.
-            # cur_len is just the length of all the chunks in cur_line.
+            # cur_len is just the visible width of all the chunks in cur_line.
             cur_line = []
             cur_len = 0
 
@@ -304,18 +2102,15 @@ class ColorTextWrapper(TextWrapper):
 
             # First chunk on line is whitespace -- drop it, unless this
             # is the very beginning of the text (ie. no lines started yet).
-            if self.drop_whitespace and strip_color(chunks[-1]).strip() == "" and lines:
+            if self.drop_whitespace and lines and _is_blank_chunk(chunks[-1]):
                 del chunks[-1]
 
             while chunks:
-                # modified upstream code, not going to refactor for ambiguous variable name.
-                l = len(strip_color(chunks[-1]))  # noqa: E741
-
                 # Can at least squeeze this chunk onto the current line.
-                # modified upstream code, not going to refactor for ambiguous variable name.
-                if cur_len + l <= width:
-                    cur_line.append(chunks.pop())
-                    cur_len += l
+                if cur_len + chunks[-1][1] <= width:
+                    chunk = chunks.pop()
+                    cur_line.append(chunk)
+                    cur_len += chunk[1]
 
                 # Nope, this line is full.
                 else:
@@ -323,37 +2118,35 @@ class ColorTextWrapper(TextWrapper):
 
             # The current line is full, and the next chunk is too big to
             # fit on *any* line (not just this one).
-            if chunks and len(strip_color(chunks[-1])) > width:
-                self._handle_long_word(chunks, cur_line, cur_len, width)
-                cur_len = sum(map(len, cur_line))
+            if chunks and chunks[-1][1] > width:
+                cur_len = self._handle_long_measured_word(chunks, cur_line, cur_len, width)
 
             # If the last chunk on this line is all whitespace, drop it.
-            if self.drop_whitespace and cur_line and strip_color(cur_line[-1]).strip() == "":
-                cur_len -= len(strip_color(cur_line[-1]))
+            if self.drop_whitespace and cur_line and _is_blank_chunk(cur_line[-1]):
+                cur_len -= cur_line[-1][1]
                 del cur_line[-1]
 
             if cur_line:
                 if (
                     self.max_lines is None
                     or len(lines) + 1 < self.max_lines
-                    or (not chunks or self.drop_whitespace and len(chunks) == 1 and not chunks[0].strip())
+                    or self._only_blank_left(chunks)
                     and cur_len <= width
                 ):
                     # Convert current line back to a string and store it in
                     # list of all lines (return value).
-                    lines.append(indent + "".join(cur_line))
+                    lines.append(indent + "".join([text for text, _ in cur_line]))
                 else:
                     while cur_line:
-                        if strip_color(cur_line[-1]).strip() and cur_len + len(self.placeholder) <= width:
-                            cur_line.append(self.placeholder)
-                            lines.append(indent + "".join(cur_line))
+                        if not _is_blank_chunk(cur_line[-1]) and cur_len + len(self.placeholder) <= width:
+                            lines.append(indent + "".join([text for text, _ in cur_line]) + self.placeholder)
                             break
-                        cur_len -= len(strip_color(cur_line[-1]))
+                        cur_len -= cur_line[-1][1]
                         del cur_line[-1]
                     else:
                         if lines:
                             prev_line = lines[-1].rstrip()
-                            if len(strip_color(prev_line)) + len(self.placeholder) <= self.width:
+                            if _chunk_width(prev_line) + len(self.placeholder) <= self.width:
                                 lines[-1] = prev_line + self.placeholder
                                 break
                         lines.append(indent + self.placeholder.lstrip())
@@ -375,8 +2168,137 @@ class ColorRawTextHelpFormatter(ColorHelpFormatterMixin, RawTextHelpFormatter):
         return super(RawTextHelpFormatter, self)._split_lines(text, width)
 
 
+# type -> (left, right) of the containers whose items are rendered one at a time in a cut down default
+_default_containers = {
+    list: ("[", "]"),
+    tuple: ("(", ")"),
+    dict: ("{", "}"),
+    set: ("{", "}"),
+    frozenset: ("frozenset({", "})"),
+}
+
+
+def _iter_default_pieces(value, limit, active=()):
+    # repr(value) in pieces, so that the items of a large container can be left off once there
+    #  are more than limit characters
+    brackets = _default_containers.get(type(value))
+    if brackets is None or not value:
+        if type(value) is str and len(value) > limit:
+            # anything past limit is cut off anyway
+            value = value[: limit + 1]
+        yield repr(value)
+        return
+    left, right = brackets
+    if id(value) in active:
+        yield "%s...%s" % (left, right)
+        return
+    active = active + (id(value),)
+    yield left
+    if type(value) is dict:
+        for i, (key, item) in enumerate(value.items()):
+            if i:
+                yield ", "
+            yield from _iter_default_pieces(key, limit, active)
+            yield ": "
+            yield from _iter_default_pieces(item, limit, active)
+    else:
+        for i, item in enumerate(value):
+            if i:
+                yield ", "
+            yield from _iter_default_pieces(item, limit, active)
+        if type(value) is tuple and len(value) == 1:
+            yield ","
+    yield right
+
+
+def _has_visible(text):
+    # whether text has anything besides escape sequences
+    pos = 0
+    match = _escape_matcher_for(text).match
+    escape = match(text)
+    while escape and escape.end() > pos:
+        pos = escape.end()
+        escape = match(text, pos)
+    return pos < len(text)
+
+
+def _cut_default(text, limit, placeholder):
+    # text, or as much of it as fits in limit columns with the placeholder after it
+    if len(text) <= limit:
+        return text
+    head_width = max(limit - _visible_width(placeholder), 0)
+    if "\x1b" not in text:
+        return text[:head_width] + placeholder
+    if not _has_visible(_break_escaped_word(text, limit, False)[1]):
+        return text
+    return _break_escaped_word(text, head_width, False)[0] + placeholder
+
+
+def _render_default(value, limit, placeholder, as_repr):
+    # str(value), or repr(value), cut down to limit columns, without rendering more of the items of
+    #  a list, tuple, dict or set than are shown
+    if as_repr or type(value) in _default_containers:
+        pieces = []
+        length = 0
+        for piece in _iter_default_pieces(value, limit):
+            pieces.append(piece)
+            length += len(piece)
+            if length > limit:
+                break
+        text = "".join(pieces)
+    else:
+        text = str(value)
+    return _cut_default(text, limit, placeholder)
+
+
+class _CutDefault(object):
+    # stands in for the default of an action when its help is expanded, so the default is only
+    #  rendered if the help shows it
+    __slots__ = ("value", "limit", "placeholder")
+
+    def __init__(self, value, limit, placeholder):
+        self.value = value
+        self.limit = limit
+        self.placeholder = placeholder
+
+    def __str__(self):
+        return _render_default(self.value, self.limit, self.placeholder, False)
+
+    def __repr__(self):
+        return _render_default(self.value, self.limit, self.placeholder, True)
+
+
 class ColorArgumentDefaultsHelpFormatter(ColorHelpFormatterMixin, ArgumentDefaultsHelpFormatter):
-    pass
+    # set to a number of columns to cut the str, list, tuple, dict and set defaults in the help
+    #  down to; large ones are then only rendered as far as they are shown
+    max_default_width = None
+    # ends a default that was cut down
+    default_placeholder = styled("...", 2)
+
+    # modified upstream code
+    # fmt: off
+    def _expand_action_help(self, action):
+        if self.max_default_width is None:
+            return super(ColorArgumentDefaultsHelpFormatter, self)._expand_action_help(action)
+        help_string = self._get_help_string(action)
+        if '%' not in help_string:
+            return help_string
+        params = dict(vars(action), prog=self._prog)
+        for name in list(params):
+            if params[name] is SUPPRESS:
+                del params[name]
+        for name in list(params):
+            if hasattr(params[name], '__name__'):
+                params[name] = params[name].__name__
+        if params.get('choices') is not None:
+            choices_str = ', '.join([str(c) for c in params['choices']])
+            params['choices'] = choices_str
+        default = params.get('default')
+        if type(default) is str or type(default) in _default_containers:
+            # anything else is left as it is, for %(default).2f and the like
+            params['default'] = _CutDefault(default, self.max_default_width, self.default_placeholder)
+        return help_string % params
+    # fmt: on
 
 
 if "MetavarTypeHelpFormatter" in globals():
@@ -0,0 +1,420 @@
+# Copyright (c) 2024, Arrai Innovations Inc.
+"""Benchmarks for argparse_color_formatter.
+
+Run with ``pipenv run benchmark``, or ``pipenv run benchmark --json results.json`` to also keep the
+results for comparing releases. Each case is timed against the matching stdlib argparse formatter or
+TextWrapper, and the ratio is the Color* time over the stdlib time.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import textwrap
+import timeit
+from contextlib import contextmanager
+from threading import Barrier
+from threading import Thread
+
+from colors import color
+from colors import strip_color
+
+import argparse_color_formatter
+from argparse_color_formatter import ColorArgumentDefaultsHelpFormatter
+from argparse_color_formatter import ColorHelpFormatter
+from argparse_color_formatter import ColorTextWrapper
+from argparse_color_formatter import HelpCache
+from argparse_color_formatter import _chunk_width
+
+
+SIZES = (10, 100, 1000, 10000)
+WIDTHS = (40, 80, 160)
+THREADS = (1, 2, 4, 8)
+TEXT_SIZES = (1, 4, 16)
+FORMATTERS = (
+    (ColorHelpFormatter, argparse.HelpFormatter),
+    (ColorArgumentDefaultsHelpFormatter, argparse.ArgumentDefaultsHelpFormatter),
+)
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+
+
+def best_of(func, number, repeat=5):
+    """Return the best time per call, in seconds, over `repeat` runs of `number` calls."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def calls_for(size):
+    """Return (number, repeat) for timing a case over `size` arguments, keeping each case short."""
+    number = max(1, 1000 // size)
+    return number, 5 if size < 10000 else 3
+
+
+@contextmanager
+def columns(width):
+    """Make formatters created inside the block use `width` columns."""
+    old_columns = os.environ.get("COLUMNS")
+    os.environ["COLUMNS"] = str(width)
+    try:
+        yield
+    finally:
+        if old_columns is None:
+            del os.environ["COLUMNS"]
+        else:
+            os.environ["COLUMNS"] = old_columns
+
+
+def help_text(i, distinct=False):
+    """Return help text for the i-th argument, every other one with colored words in it.
+
+    With `distinct`, no word is used in the help of two arguments, as in real help.
+    """
+    words = [WORDS[(i + j) % len(WORDS)] for j in range(4 + i % 12)]
+    if distinct:
+        words = ["%s%d" % (word, i * 16 + j) for j, word in enumerate(words)]
+    if i % 2:
+        words = [color(word, fg="cyan", style="bold") if j % 3 == 0 else word for j, word in enumerate(words)]
+    return " ".join(words)
+
+
+def synthetic_parser(size, formatter_class, distinct=False):
+    """Return a parser with `size` arguments, a tenth of them spread over nested subparsers."""
+    parser = argparse.ArgumentParser(
+        prog=color("synthetic", fg="green"),
+        description=" ".join(WORDS * 6),
+        epilog=help_text(1),
+        formatter_class=formatter_class,
+    )
+    top_level = size - size // 10
+    for i in range(top_level):
+        if i % 10 == 9:
+            parser.add_argument("input%d" % i, nargs="?", help=help_text(i, distinct))
+        elif i % 2:
+            parser.add_argument(
+                "--option-%d" % i, metavar=color("VALUE", fg="yellow"), default=i, help=help_text(i, distinct)
+            )
+        else:
+            parser.add_argument("-o%d" % i, "--flag-%d" % i, action="store_true", help=help_text(i, distinct))
+    if size >= 10:
+        commands = parser.add_subparsers(dest="command", help="the command to run")
+        per_command = 10
+        for c in range(max(1, (size - top_level) // per_command)):
+            command = commands.add_parser(
+                "command-%d" % c, help=help_text(c, distinct), formatter_class=formatter_class
+            )
+            nested = command.add_subparsers(dest="subcommand").add_parser("nested", formatter_class=formatter_class)
+            for i in range(per_command):
+                target = nested if i % 2 else command
+                target.add_argument("--argument-%d" % i, help=help_text(i, distinct))
+    return parser
+
+
+def bench_parsers(sizes=SIZES, widths=WIDTHS):
+    """Time format_help() and format_usage() of synthetic parsers against the stdlib formatters.
+
+    The distinct_help case formats the help of parsers with no word used by two arguments, whose
+    words are each measured once, instead of over and over.
+    """
+    results = []
+    for size in sizes:
+        number, repeat = calls_for(size)
+        for color_class, stdlib_class in FORMATTERS:
+            color_parser = synthetic_parser(size, color_class)
+            stdlib_parser = synthetic_parser(size, stdlib_class)
+            cases = (
+                ("format_help", color_parser.format_help, stdlib_parser.format_help),
+                ("format_usage", color_parser.format_usage, stdlib_parser.format_usage),
+                (
+                    "distinct_help",
+                    synthetic_parser(size, color_class, distinct=True).format_help,
+                    synthetic_parser(size, stdlib_class, distinct=True).format_help,
+                ),
+            )
+            for width in widths:
+                with columns(width):
+                    for benchmark, color_method, stdlib_method in cases:
+                        candidate = best_of(color_method, number, repeat)
+                        baseline = best_of(stdlib_method, number, repeat)
+                        results.append(
+                            {
+                                "benchmark": benchmark,
+                                "formatter": color_class.__name__,
+                                "baseline": stdlib_class.__name__,
+                                "arguments": size,
+                                "width": width,
+                                "seconds": candidate,
+                                "baseline_seconds": baseline,
+                                "ratio": candidate / baseline,
+                            }
+                        )
+    return results
+
+
+def bench_wrap(sizes=SIZES, widths=WIDTHS):
+    """Time ColorTextWrapper.wrap() against TextWrapper.wrap() on text of `size` words."""
+    results = []
+    for size in sizes:
+        number, repeat = calls_for(size)
+        text = " ".join(help_text(i) for i in range(size // 4 or 1))
+        for width in widths:
+            candidate = best_of(lambda text=text, width=width: ColorTextWrapper(width=width).wrap(text), number, repeat)
+            baseline = best_of(
+                lambda text=text, width=width: textwrap.TextWrapper(width=width).wrap(text), number, repeat
+            )
+            results.append(
+                {
+                    "benchmark": "wrap",
+                    "formatter": "ColorTextWrapper",
+                    "baseline": "TextWrapper",
+                    "arguments": size,
+                    "width": width,
+                    "seconds": candidate,
+                    "baseline_seconds": baseline,
+                    "ratio": candidate / baseline,
+                }
+            )
+    return results
+
+
+def long_text(kilobytes, colored):
+    """Return a paragraph of about `kilobytes` KB, in indented source lines as docstrings are."""
+    words = []
+    size = 0
+    i = 0
+    while size < kilobytes * 1024:
+        word = WORDS[i % len(WORDS)] if i % 9 else "well-known"
+        if colored and i % 5 == 0:
+            word = color(word, fg="magenta")
+        words.append(word)
+        size += len(word) + 1
+        i += 1
+    return "\n    ".join(" ".join(words[start : start + 10]) for start in range(0, len(words), 10))
+
+
+def bench_long_text(sizes=TEXT_SIZES, widths=WIDTHS):
+    """Time format_help() of parsers with a description and epilog of `size` KB each."""
+    results = []
+    for size in sizes:
+        number, repeat = calls_for(size * 10)
+        for colored in (False, True):
+            parsers = [
+                argparse.ArgumentParser(
+                    prog="long-text",
+                    description=long_text(size, colored),
+                    epilog=long_text(size, colored),
+                    formatter_class=formatter_class,
+                )
+                for formatter_class in (ColorHelpFormatter, argparse.HelpFormatter)
+            ]
+            for width in widths:
+                with columns(width):
+                    candidate = best_of(parsers[0].format_help, number, repeat)
+                    baseline = best_of(parsers[1].format_help, number, repeat)
+                results.append(
+                    {
+                        "benchmark": "long_text",
+                        "colored": colored,
+                        "kilobytes": size,
+                        "width": width,
+                        "seconds": candidate,
+                        "baseline_seconds": baseline,
+                        "ratio": candidate / baseline,
+                    }
+                )
+    return results
+
+
+def write_long_text(results):
+    sys.stdout.write(
+        "{:<14}{:>10}{:>10}{:>7}{:>14}{:>14}{:>8}\n".format(
+            "text", "colored", "KB", "width", "color", "stdlib", "ratio"
+        )
+    )
+    for result in results:
+        sys.stdout.write(
+            "{benchmark:<14}{colored!s:>10}{kilobytes:>10}{width:>7}"
+            "{color_ms:>11.3f} ms{stdlib_ms:>11.3f} ms{ratio:>7.2f}x\n".format(
+                color_ms=result["seconds"] * 1e3, stdlib_ms=result["baseline_seconds"] * 1e3, **result
+            )
+        )
+
+
+def bench_threads(thread_counts=THREADS, renders=400):
+    """Time `renders` format_help() calls spread over threads, for as many tenants' parsers.
+
+    In the "shared cache" case, the formatters of every thread share one HelpCache, so nearly all
+    renders are cache reads; in "uncached" every render formats the help, sharing the width cache.
+    Renders only run in parallel on free-threaded builds of CPython.
+    """
+    results = []
+
+    class SharedCacheHelpFormatter(ColorHelpFormatter):
+        help_cache = HelpCache(maxsize=64)
+
+    for case, formatter_class in (("shared cache", SharedCacheHelpFormatter), ("uncached", ColorHelpFormatter)):
+        parsers = [synthetic_parser(100, formatter_class) for _ in range(32)]
+        for i, parser in enumerate(parsers):
+            parser.prog = color("tenant-%d" % i, fg="green")
+        with columns(80):
+            for parser in parsers:
+                parser.format_help()
+            single = None
+            for count in thread_counts:
+                per_thread = renders // count
+                barrier = Barrier(count + 1)
+
+                def render(offset, parsers=parsers, per_thread=per_thread, barrier=barrier):
+                    barrier.wait()
+                    for i in range(per_thread):
+                        parsers[(offset + i) % len(parsers)].format_help()
+
+                threads = [Thread(target=render, args=(offset,)) for offset in range(count)]
+                for thread in threads:
+                    thread.start()
+                barrier.wait()
+                start = timeit.default_timer()
+                for thread in threads:
+                    thread.join()
+                seconds = timeit.default_timer() - start
+                throughput = per_thread * count / seconds
+                single = single or throughput
+                results.append(
+                    {
+                        "benchmark": "threads",
+                        "case": case,
+                        "threads": count,
+                        "renders": per_thread * count,
+                        "seconds": seconds,
+                        "renders_per_second": throughput,
+                        "scaling": throughput / single,
+                    }
+                )
+    return results
+
+
+def write_threads(results):
+    sys.stdout.write("{:<16}{:>8}{:>10}{:>16}{:>10}\n".format("threads", "count", "renders", "renders/s", "scaling"))
+    for result in results:
+        sys.stdout.write(
+            "{case:<16}{threads:>8}{renders:>10}{renders_per_second:>16.0f}{scaling:>9.2f}x\n".format(**result)
+        )
+
+
+def visible_width_samples():
+    return {
+        "short plain": "--output",
+        "short colored": color("--output", fg="red", style="bold"),
+        "long plain": " ".join(WORDS * 150),
+        "long colored": " ".join(color(word, fg="green") if i % 3 else word for i, word in enumerate(WORDS * 150)),
+        "long hyperlinked": " ".join(
+            "\x1b]8;;https://example.com/{0}\x1b\\{0}\x1b]8;;\x1b\\".format(word) for word in WORDS * 150
+        ),
+    }
+
+
+def bench_visible_width():
+    """Compare scanning a string for its visible width against len(strip_color()) from ansicolors.
+
+    The scan is timed with _chunk_width(), as _visible_width() would only time a width_cache hit
+    after the first call.
+    """
+    results = []
+    for name, text in visible_width_samples().items():
+        number = 200 if len(text) > 1000 else 20000
+        baseline = best_of(lambda text=text: len(strip_color(text)), number)
+        candidate = best_of(lambda text=text: _chunk_width(text), number)
+        agrees = len(strip_color(text)) == _chunk_width(text)
+        results.append((name, baseline, candidate, agrees))
+    return results
+
+
+def write_visible_width(results):
+    sys.stdout.write("{:<20}{:>16}{:>16}{:>10}\n".format("visible width", "strip_color", "_chunk_width", "speedup"))
+    for name, baseline, candidate, agrees in results:
+        sys.stdout.write(
+            "{:<20}{:>13.0f} ns{:>13.0f} ns{:>9.2f}x{}\n".format(
+                name,
+                baseline * 1e9,
+                candidate * 1e9,
+                baseline / candidate,
+                "" if agrees else "  (strip_color width is wrong)",
+            )
+        )
+
+
+def write_results(results):
+    sys.stdout.write(
+        "{:<14}{:<36}{:>10}{:>7}{:>14}{:>14}{:>8}\n".format(
+            "benchmark", "formatter", "arguments", "width", "color", "stdlib", "ratio"
+        )
+    )
+    for result in results:
+        sys.stdout.write(
+            "{benchmark:<14}{formatter:<36}{arguments:>10}{width:>7}"
+            "{color_ms:>11.3f} ms{stdlib_ms:>11.3f} ms{ratio:>7.2f}x\n".format(
+                color_ms=result["seconds"] * 1e3, stdlib_ms=result["baseline_seconds"] * 1e3, **result
+            )
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--json", metavar="PATH", help="also write the results to PATH as JSON")
+    parser.add_argument(
+        "--sizes", metavar="N", type=int, nargs="+", default=SIZES, help="numbers of arguments to benchmark"
+    )
+    parser.add_argument("--widths", metavar="W", type=int, nargs="+", default=WIDTHS, help="terminal widths")
+    parser.add_argument(
+        "--text-sizes",
+        metavar="KB",
+        type=int,
+        nargs="+",
+        default=TEXT_SIZES,
+        help="sizes of the descriptions and epilogs to benchmark, in KB",
+    )
+    parser.add_argument(
+        "--threads", metavar="T", type=int, nargs="+", default=THREADS, help="thread counts for the stress benchmark"
+    )
+    args = parser.parse_args(argv)
+
+    visible_width = bench_visible_width()
+    write_visible_width(visible_width)
+    sys.stdout.write("\n")
+    results = bench_parsers(args.sizes, args.widths) + bench_wrap(args.sizes, args.widths)
+    write_results(results)
+    sys.stdout.write("\n")
+    text_results = bench_long_text(args.text_sizes, args.widths)
+    write_long_text(text_results)
+    sys.stdout.write("\n")
+    threads = bench_threads(args.threads)
+    write_threads(threads)
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(
+                {
+                    "version": argparse_color_formatter.__version__,
+                    "python": platform.python_version(),
+                    "implementation": platform.python_implementation(),
+                    "free_threaded": not getattr(sys, "_is_gil_enabled", lambda: True)(),
+                    "results": results,
+                    "long_text": text_results,
+                    "threads": threads,
+                    "visible_width": [
+                        {
+                            "sample": name,
+                            "seconds": candidate,
+                            "baseline_seconds": baseline,
+                            "ratio": candidate / baseline,
+                        }
+                        for name, baseline, candidate, _ in visible_width
+                    ],
+                },
+                json_file,
+                indent=2,
+            )
+            json_file.write("\n")
+
+
+if __name__ == "__main__":
+    main()
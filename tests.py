@@ -1,12 +1,27 @@
 # Copyright (c) 2017, Emergence by Design Inc.
 
 import argparse
+import html
+import itertools
+import json
 import os
+import pickle
+import re
+import subprocess
 import sys
+import tempfile
+import time
+import zipfile
 from collections import OrderedDict
+from decimal import Decimal
+from fractions import Fraction
 from functools import partial
 from io import StringIO
+from textwrap import TextWrapper
+from threading import Event
+from threading import Thread
 from unittest import TestCase
+from unittest import mock
 from unittest import skipUnless
 
 from colors import bold
@@ -14,8 +29,18 @@ from colors import color
 from colors import strip_color
 from colors import underline
 
+import argparse_color_formatter
+from argparse_color_formatter import ColorArgumentDefaultsHelpFormatter
 from argparse_color_formatter import ColorHelpFormatter
+from argparse_color_formatter import ColorHelpFormatterMixin
 from argparse_color_formatter import ColorTextWrapper
+from argparse_color_formatter import FormattingProfile
+from argparse_color_formatter import HelpCache
+from argparse_color_formatter import HelpSnapshot
+from argparse_color_formatter import StyledStr
+from argparse_color_formatter import WidthCache
+from argparse_color_formatter import export_help
+from argparse_color_formatter import styled
 
 
 try:
@@ -616,6 +641,1376 @@ class TestColorArgsParserOutput(TestCase):
                 os.environ["PYTHON_COLORS"] = old_python_colors
 
 
+def plain_parser(formatter_class):
+    parser = argparse.ArgumentParser(
+        prog="plain-tool",
+        description="This description has no escapes in it, " * 8,
+        epilog="This epilog is plain as well, and long enough to wrap. " * 3,
+        formatter_class=formatter_class,
+    )
+    for i in range(10):
+        parser.add_argument("--option-%d" % i, metavar="VALUE", default=i, help="help for option %d, " % i * 6)
+    parser.add_argument("positional", nargs="*", help="some positional arguments")
+    subparsers = parser.add_subparsers(dest="command", help="the command to run")
+    for name in ("first", "second", "third"):
+        subparsers.add_parser(name, help="the %s command" % name)
+    return parser
+
+
+def count_calls(func):
+    calls = 0
+
+    def profiler(frame, event, arg):
+        nonlocal calls
+        if event in ("call", "c_call"):
+            calls += 1
+
+    sys.setprofile(profiler)
+    try:
+        func()
+    finally:
+        sys.setprofile(None)
+    return calls
+
+
+class TestPlainTextFastPath(TestCase):
+    maxDiff = None
+
+    def test_plain_output_matches_stdlib(self):
+        formatter_classes = (
+            (ColorHelpFormatter, argparse.HelpFormatter),
+            (ColorArgumentDefaultsHelpFormatter, argparse.ArgumentDefaultsHelpFormatter),
+        )
+        for columns in ("40", "80", "160"):
+            for color_class, stdlib_class in formatter_classes:
+                environ = mock.patch.dict(os.environ, {"COLUMNS": columns})
+                with self.subTest(columns=columns, formatter_class=color_class.__name__), environ:
+                    self.assertEqual(
+                        plain_parser(color_class).format_help(),
+                        plain_parser(stdlib_class).format_help(),
+                    )
+
+    def test_help_split_without_text_wrapper_passes(self):
+        parser = plain_parser(ColorHelpFormatter)
+        parser.add_argument("--colored", help=bold("colored") + " help with some-hyphenated --words")
+        with (
+            mock.patch.object(TextWrapper, "_munge_whitespace") as munge,
+            mock.patch.object(TextWrapper, "_split_chunks") as split_chunks,
+        ):
+            parser.format_help()
+        munge.assert_not_called()
+        split_chunks.assert_not_called()
+
+    def test_collapsed_chunks_match_text_wrapper(self):
+        ctw = ColorTextWrapper()
+        texts = (
+            "",
+            " \n ",
+            "  plain words,\n\tand some-hyphenated ones -- and em-dashes--like this, a-b-c and 3-4  ",
+            bold("colored-words") + " " + underline("x--y") + " with\xa0odd\u2003spaces-",
+            "\x1b]8;;https://example.com/some-path\x1b\\a link\x1b]8;;\x1b\\",
+        )
+        for text in texts:
+            for break_on_hyphens in (True, False):
+                ctw.break_on_hyphens = break_on_hyphens
+                with self.subTest(text=text, break_on_hyphens=break_on_hyphens):
+                    self.assertEqual(
+                        ctw._split_collapsed_chunks(text),
+                        ctw._split_measured_chunks(re.sub(r"\s+", " ", text, flags=re.ASCII).strip()),
+                    )
+
+    def test_wrappers_reused(self):
+        parser = plain_parser(ColorHelpFormatter)
+        parser.add_argument("--colored", help=bold("colored") + " help")
+        with (
+            mock.patch.object(
+                ColorTextWrapper, "__init__", autospec=True, side_effect=ColorTextWrapper.__init__
+            ) as init,
+            mock.patch.dict(os.environ, {"COLUMNS": "80"}),
+        ):
+            help_text = parser.format_help()
+        # one for the help of every action, and one for the description and epilog
+        self.assertEqual(init.call_count, 2)
+        with mock.patch.dict(os.environ, {"COLUMNS": "80"}):
+            self.assertEqual(help_text, parser.format_help())
+
+    def test_plain_help_costs_no_more_than_stdlib(self):
+        with mock.patch.dict(os.environ, {"COLUMNS": "80"}):
+            color_parser = plain_parser(ColorHelpFormatter)
+            stdlib_parser = plain_parser(argparse.HelpFormatter)
+            color_calls = count_calls(color_parser.format_help)
+            stdlib_calls = count_calls(stdlib_parser.format_help)
+        self.assertLessEqual(color_calls, stdlib_calls * 1.05)
+
+
+def grouped_parser(formatter_class, mixed):
+    parser = argparse.ArgumentParser(prog="grouped-tool", formatter_class=formatter_class)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--verbose", action="store_true")
+    group.add_argument("--quiet", action="store_true")
+    for i in range(6):
+        parser.add_argument("--option-%d" % i, metavar="VALUE")
+    required = parser.add_mutually_exclusive_group(required=True)
+    required.add_argument("--first", metavar="FIRST")
+    if mixed:
+        required.add_argument("second", nargs="?")
+    else:
+        required.add_argument("--second", metavar="SECOND")
+    parser.add_argument("files", nargs="*")
+    return parser
+
+
+class TestUsageParts(TestCase):
+    maxDiff = None
+
+    def test_usage_matches_stdlib(self):
+        for columns in ("30", "60", "200"):
+            for mixed in (False, True):
+                with self.subTest(columns=columns, mixed=mixed), mock.patch.dict(os.environ, {"COLUMNS": columns}):
+                    self.assertEqual(
+                        grouped_parser(ColorHelpFormatter, mixed).format_usage(),
+                        grouped_parser(argparse.HelpFormatter, mixed).format_usage(),
+                    )
+
+    @skipUnless(hasattr(argparse.HelpFormatter, "_format_actions_usage"), "only Python < 3.14 composes usage")
+    def test_usage_composed_once_per_half(self):
+        for mixed, composes in ((False, 2), (True, 3)):
+            parser = grouped_parser(ColorHelpFormatter, mixed)
+            if hasattr(argparse.HelpFormatter, "_get_actions_usage_parts"):
+                name = "_get_actions_usage_parts"
+            else:
+                name = "_format_actions_usage"
+            original = getattr(argparse.HelpFormatter, name)
+            with self.subTest(mixed=mixed), mock.patch.dict(os.environ, {"COLUMNS": "30"}):
+                with mock.patch.object(argparse.HelpFormatter, name, autospec=True, side_effect=original) as compose:
+                    parser.format_usage()
+                self.assertEqual(compose.call_count, composes)
+
+    def test_long_prog_matches_stdlib(self):
+        prog = "a-program-name-long-enough-to-go-on-its-own-line"
+        for columns in ("40", "90", "200"):
+            color_parser = grouped_parser(ColorHelpFormatter, mixed=False)
+            stdlib_parser = grouped_parser(argparse.HelpFormatter, mixed=False)
+            color_parser.prog = stdlib_parser.prog = prog
+            with self.subTest(columns=columns), mock.patch.dict(os.environ, {"COLUMNS": columns}):
+                self.assertEqual(color_parser.format_usage(), stdlib_parser.format_usage())
+
+    def test_parts_measured_once(self):
+        parser = grouped_parser(ColorHelpFormatter, mixed=False)
+        parser.prog = bold("a-program-name-long-enough-to-go-on-its-own-line")
+        visible_width = argparse_color_formatter._visible_width
+        with (
+            mock.patch.dict(os.environ, {"COLUMNS": "40"}),
+            mock.patch.object(argparse_color_formatter, "_visible_width", side_effect=visible_width) as measure,
+        ):
+            parser.format_usage()
+        measured = [call.args[0] for call in measure.call_args_list]
+        self.assertEqual(len(measured), len(set(measured)))
+
+    def test_colored_parts_are_measured(self):
+        parser = argparse.ArgumentParser(prog=bold("tool"), formatter_class=ColorHelpFormatter)
+        for name in ("alpha", "beta", "gamma"):
+            parser.add_argument("--" + name, metavar=bold(name.upper()))
+        with mock.patch.dict(os.environ, {"COLUMNS": "40"}):
+            usage = parser.format_usage()
+        self.assertEqual(
+            strip_color(usage),
+            "usage: tool [-h] [--alpha ALPHA]\n            [--beta BETA]\n            [--gamma GAMMA]\n",
+        )
+
+
+class TestInvocationCache(TestCase):
+    def test_each_invocation_formatted_once(self):
+        parser = argparse.ArgumentParser(prog="tool", formatter_class=ColorHelpFormatter)
+        subparsers = parser.add_subparsers(help="commands")
+        for i in range(25):
+            subparsers.add_parser("command-%d" % i, help=color_names["blue"])
+        with mock.patch.object(
+            argparse.HelpFormatter,
+            "_format_action_invocation",
+            autospec=True,
+            side_effect=argparse.HelpFormatter._format_action_invocation,
+        ) as format_invocation:
+            output = parser.format_help()
+        # -h, the subparsers action, and one for each command
+        self.assertEqual(format_invocation.call_count, 27)
+        self.assertEqual(len({id(call.args[1]) for call in format_invocation.call_args_list}), 27)
+        self.assertIn("    command-24          {}\n".format(color_names["blue"]), output)
+
+    def test_subaction_column_matches_stdlib(self):
+        def make_parser(formatter_class, name):
+            parser = argparse.ArgumentParser(prog="tool", formatter_class=formatter_class)
+            subparsers = parser.add_subparsers(title="commands", metavar="COMMAND")
+            subparsers.add_parser(name, help="a command")
+            subparsers.add_parser("b", help="another command")
+            return parser
+
+        for name in ("a" * 12, "a" * 16, "a" * 18, "a" * 30):
+            with self.subTest(name=name), mock.patch.dict(os.environ, {"COLUMNS": "80"}):
+                self.assertEqual(
+                    make_parser(ColorHelpFormatter, name).format_help(),
+                    make_parser(argparse.HelpFormatter, name).format_help(),
+                )
+
+    def test_action_max_length_matches_stdlib(self):
+        parser = argparse.ArgumentParser(prog="tool")
+        subparsers = parser.add_subparsers(dest="command")
+        for i in range(0, 2000, 7):
+            subparsers.add_parser("c" * (i % 23 + 1) + str(i), help="command %d" % i)
+        parser.add_argument("--option", metavar="X" * 19)
+        color_formatter = ColorHelpFormatter("tool")
+        stdlib_formatter = argparse.HelpFormatter("tool")
+        for formatter in (color_formatter, stdlib_formatter):
+            formatter.start_section("commands")
+            formatter.add_arguments(parser._actions)
+            formatter.end_section()
+        self.assertEqual(color_formatter._action_max_length, stdlib_formatter._action_max_length)
+
+    def test_cache_is_per_formatter(self):
+        parser = argparse.ArgumentParser(prog="tool", formatter_class=ColorHelpFormatter)
+        action = parser.add_argument("--name", metavar=bold("NAME"))
+        first = parser._get_formatter()
+        second = parser._get_formatter()
+        self.assertEqual(first._format_action_invocation(action), "--name {}".format(bold("NAME")))
+        self.assertIn(action, first._invocation_cache)
+        self.assertNotIn(action, second._invocation_cache)
+
+
+class TestHelpCache(TestCase):
+    def setUp(self):
+        self.help_cache = HelpCache(maxsize=4)
+
+        class CachedColorHelpFormatter(ColorHelpFormatter):
+            help_cache = self.help_cache
+
+        self.formatter_class = CachedColorHelpFormatter
+        self.parser = argparse.ArgumentParser(prog=bold("tool"), formatter_class=self.formatter_class)
+        self.parser.add_argument("--name", metavar=bold("NAME"), help="the {} to use".format(underline("name")))
+        self.environ = mock.patch.dict(os.environ, {"COLUMNS": "80"})
+        self.environ.start()
+        self.addCleanup(self.environ.stop)
+
+    def render_count(self, func):
+        with mock.patch.object(
+            argparse.HelpFormatter, "format_help", autospec=True, side_effect=argparse.HelpFormatter.format_help
+        ) as format_help:
+            output = func()
+        return output, format_help.call_count
+
+    def test_not_cached_by_default(self):
+        self.assertIsNone(ColorHelpFormatter.help_cache)
+        parser = argparse.ArgumentParser(prog="tool", formatter_class=ColorHelpFormatter)
+        parser.format_help()
+        _, renders = self.render_count(parser.format_help)
+        self.assertEqual(renders, 1)
+
+    def test_help_and_usage_are_reused(self):
+        first_help, renders = self.render_count(self.parser.format_help)
+        self.assertEqual(renders, 1)
+        first_usage, renders = self.render_count(self.parser.format_usage)
+        self.assertEqual(renders, 1)
+        second_help, renders = self.render_count(self.parser.format_help)
+        self.assertEqual((second_help, renders), (first_help, 0))
+        second_usage, renders = self.render_count(self.parser.format_usage)
+        self.assertEqual((second_usage, renders), (first_usage, 0))
+        self.assertEqual(len(self.help_cache), 2)
+
+    def test_error_reuses_usage(self):
+        self.parser.format_usage()
+        with redirect_stderr(StringIO()) as err:
+            _, renders = self.render_count(lambda: self.assertRaises(SystemExit, self.parser.parse_args, ["--bad"]))
+        self.assertEqual(renders, 0)
+        self.assertTrue(err.getvalue().startswith(self.parser.format_usage()))
+
+    def test_add_argument_after_render_invalidates(self):
+        before = self.parser.format_help()
+        self.parser.add_argument("--extra", help="added after the first render")
+        after, renders = self.render_count(self.parser.format_help)
+        self.assertEqual(renders, 1)
+        self.assertNotEqual(before, after)
+        self.assertIn("added after the first render", after)
+
+    def test_each_action_fingerprinted_once(self):
+        big = list(range(10**5))
+        self.parser.add_argument("--big", default=big)
+        self.parser.format_help()
+        fingerprint_action = mock.patch.object(
+            argparse_color_formatter,
+            "_fingerprint_new_action",
+            wraps=argparse_color_formatter._fingerprint_new_action,
+        )
+        with fingerprint_action as fingerprint:
+            _, renders = self.render_count(self.parser.format_help)
+        self.assertEqual(renders, 0)
+        # -h, --name and --big, each used by the usage and the options section
+        self.assertEqual(fingerprint.call_count, 3)
+        # large defaults are fingerprinted by a digest of their items
+        fingerprint = argparse_color_formatter._fingerprint_value(big)
+        self.assertEqual(fingerprint[:2], ("builtins.list", 10**5))
+        self.assertEqual(len(fingerprint[2]), 64)
+
+    def test_large_defaults_fingerprinted_by_content(self):
+        class CachedDefaultsHelpFormatter(ColorArgumentDefaultsHelpFormatter):
+            help_cache = self.help_cache
+
+        helps = []
+        plugins = ["b%d" % i for i in range(65)]
+        for prefix in ("a", "b"):
+            parser = argparse.ArgumentParser(prog="tool", formatter_class=CachedDefaultsHelpFormatter)
+            parser.add_argument("--plugins", default=[prefix + str(i) for i in range(65)], help="plugins")
+            parser.add_argument("--more", default={str(i) for i in range(65)}, help="more")
+            helps.append(parser.format_help())
+        self.assertIn("'a64'", helps[0])
+        self.assertIn("'b64'", helps[1])
+        self.assertNotIn("'a0'", helps[1])
+        # changed in place, without changing its length
+        parser._actions[1].default[0] = "changed"
+        self.assertIn("'changed', 'b1'", parser.format_help())
+        parser._actions[1].default = plugins
+        self.assertEqual(self.render_count(parser.format_help), (helps[1], 0))
+
+    def test_changed_help_and_width_invalidate(self):
+        before = self.parser.format_help()
+        self.parser._actions[-1].help = "different help"
+        self.assertIn("different help", self.parser.format_help())
+        os.environ["COLUMNS"] = "40"
+        narrow, renders = self.render_count(self.parser.format_help)
+        self.assertEqual(renders, 1)
+        self.assertNotEqual(before, narrow)
+
+    def test_default_with_address_in_repr(self):
+        class Cfg(object):
+            def __init__(self, name):
+                self.name = name
+
+            def __str__(self):
+                return self.name
+
+        class CachedDefaultsHelpFormatter(ColorArgumentDefaultsHelpFormatter):
+            help_cache = self.help_cache
+
+        parser = argparse.ArgumentParser(prog="tool", formatter_class=CachedDefaultsHelpFormatter)
+        parser.add_argument("--config", default=Cfg("alpha"), help="the config")
+        self.assertIn("(default: alpha)", parser.format_help())
+        parser._actions[-1].default = Cfg("beta")
+        self.assertIn("(default: beta)", parser.format_help())
+        parser._actions[-1].default = Cfg("beta")
+        self.assertEqual(self.render_count(parser.format_help)[1], 0)
+
+    def test_least_recently_used_is_evicted(self):
+        self.help_cache = HelpCache(maxsize=2)
+        self.formatter_class.help_cache = self.help_cache
+        parsers = [argparse.ArgumentParser(prog="tool%d" % i, formatter_class=self.formatter_class) for i in range(3)]
+        parsers[0].format_usage()
+        parsers[1].format_usage()
+        parsers[0].format_usage()
+        parsers[2].format_usage()
+        self.assertEqual(len(self.help_cache), 2)
+        self.assertEqual(self.render_count(parsers[0].format_usage)[1], 0)
+        self.assertEqual(self.render_count(parsers[1].format_usage)[1], 1)
+
+    def test_matches_uncached_output(self):
+        subparsers = self.parser.add_subparsers(help="commands")
+        for name in ("first", "second", "a-much-longer-{}".format(color_names["red"])):
+            subparsers.add_parser(name, help="the %s command" % name)
+        cached = self.parser.format_help()
+        self.parser.formatter_class = ColorHelpFormatter
+        self.assertEqual(cached, self.parser.format_help())
+
+    def test_invalid_maxsize(self):
+        self.assertRaisesRegex(ValueError, r"invalid maxsize 0 \(must be > 0\)", HelpCache, maxsize=0)
+
+
+class TestHelpSnapshot(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.environ = mock.patch.dict(os.environ, {"COLUMNS": "80"})
+        self.environ.start()
+        self.addCleanup(self.environ.stop)
+
+    def make_parser(self):
+        class SnapshotHelpFormatter(ColorHelpFormatter):
+            help_cache = HelpSnapshot(self.directory.name)
+
+        parser = argparse.ArgumentParser(prog=bold("tool"), formatter_class=SnapshotHelpFormatter)
+        parser.add_argument("--name", metavar=bold("NAME"), help="the {} to use".format(underline("name")))
+        return parser
+
+    def test_later_runs_skip_formatting(self):
+        expected = self.make_parser().format_help()
+        self.assertEqual(len(os.listdir(self.directory.name)), 1)
+        with (
+            mock.patch.object(argparse.HelpFormatter, "format_help") as format_help,
+            mock.patch.object(argparse.HelpFormatter, "_format_action_invocation") as format_invocation,
+        ):
+            self.assertEqual(self.make_parser().format_help(), expected)
+        format_help.assert_not_called()
+        format_invocation.assert_not_called()
+
+    def test_usage_and_widths_are_separate_snapshots(self):
+        parser = self.make_parser()
+        parser.format_help()
+        parser.format_usage()
+        os.environ["COLUMNS"] = "40"
+        parser.format_usage()
+        self.assertEqual(len(os.listdir(self.directory.name)), 3)
+
+    def test_new_version_ignores_old_snapshots(self):
+        expected = self.make_parser().format_help()
+        with (
+            mock.patch.object(argparse_color_formatter, "__version__", "0.0.0"),
+            mock.patch.object(
+                argparse.HelpFormatter, "format_help", autospec=True, side_effect=argparse.HelpFormatter.format_help
+            ) as format_help,
+        ):
+            self.assertEqual(self.make_parser().format_help(), expected)
+        format_help.assert_called_once()
+        self.assertEqual(len(os.listdir(self.directory.name)), 2)
+
+    def test_unreadable_snapshot_is_rendered_again(self):
+        expected = self.make_parser().format_help()
+        (name,) = os.listdir(self.directory.name)
+        with open(os.path.join(self.directory.name, name), "wb") as snapshot:
+            snapshot.write(b"\xff\xfe")
+        self.assertEqual(self.make_parser().format_help(), expected)
+
+    def test_unwritable_directory_still_renders(self):
+        file_path = os.path.join(self.directory.name, "not-a-directory")
+        open(file_path, "w").close()
+
+        class SnapshotHelpFormatter(ColorHelpFormatter):
+            help_cache = HelpSnapshot(file_path)
+
+        parser = argparse.ArgumentParser(prog="tool", formatter_class=SnapshotHelpFormatter)
+        self.assertEqual(parser.format_usage(), "usage: tool [-h]\n")
+        self.assertEqual(os.listdir(self.directory.name), ["not-a-directory"])
+
+    def test_clear(self):
+        snapshot = HelpSnapshot(self.directory.name)
+        snapshot.set(("key",), "value")
+        self.assertEqual(snapshot.get(("key",)), "value")
+        snapshot.clear()
+        self.assertIsNone(snapshot.get(("key",)))
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_clear_ignores_unlink_errors(self):
+        snapshot = HelpSnapshot(self.directory.name)
+        snapshot.set(("key",), "value")
+        with mock.patch.object(os, "unlink", side_effect=PermissionError):
+            snapshot.clear()
+
+    def test_snapshot_stable_across_runs(self):
+        # a sentinel default, whose repr has its address, and sets, whose order follows
+        #  PYTHONHASHSEED, are fingerprinted the same in every run
+        script = "\n".join(
+            [
+                "import argparse, sys",
+                "import argparse_color_formatter as acf",
+                "class F(acf.ColorHelpFormatter):",
+                "    help_cache = acf.HelpSnapshot(sys.argv[1])",
+                "parser = argparse.ArgumentParser(prog='tool', formatter_class=F)",
+                "parser.add_argument('--sentinel', default=object())",
+                "parser.add_argument('--tags', default=frozenset('abcdefgh'), choices=set('abcdefgh'))",
+                "parser.format_help()",
+            ]
+        )
+        for seed in ("1", "2", "3"):
+            subprocess.run(
+                [sys.executable, "-c", script, self.directory.name],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env=dict(os.environ, PYTHONHASHSEED=seed),
+                check=True,
+            )
+        self.assertEqual(len(os.listdir(self.directory.name)), 1)
+
+
+class TestHelpLayout(TestCase):
+    maxDiff = None
+
+    def layout_parsers(self):
+        colored = argparse.ArgumentParser(
+            prog=color("tool", fg="green"),
+            description=rainbow_text("a description with colors in it " * 4),
+            formatter_class=ColorHelpFormatter,
+        )
+        colored.add_argument("--name", metavar=bold("NAME"), help="the {} to use, ".format(underline("name")) * 5)
+        colored.add_argument("items", nargs="*", help="the items")
+        return (
+            plain_parser(ColorHelpFormatter),
+            plain_parser(ColorArgumentDefaultsHelpFormatter),
+            grouped_parser(ColorHelpFormatter, mixed=True),
+            colored,
+        )
+
+    def test_layout_matches_format_help(self):
+        for parser in self.layout_parsers():
+            layout = argparse_color_formatter.HelpLayout(parser)
+            for width in (10, 38, 78, 158, 78):
+                environ = mock.patch.dict(os.environ, {"COLUMNS": str(width + 2)})
+                with self.subTest(prog=parser.prog, width=width), environ:
+                    self.assertEqual(layout.format_help(width), parser.format_help())
+                    self.assertEqual(layout.format_usage(width), parser.format_usage())
+                    self.assertEqual(layout.format_help(), parser.format_help())
+
+    def test_later_widths_only_wrap(self):
+        parser = self.layout_parsers()[-1]
+        layout = argparse_color_formatter.HelpLayout(parser)
+        layout.format_help(78)
+        split_patch = mock.patch.object(ColorTextWrapper, "_split_measured_chunks", autospec=True)
+        invocation_patch = mock.patch.object(argparse.HelpFormatter, "_format_action_invocation", autospec=True)
+        width_patch = mock.patch.object(
+            argparse_color_formatter, "_visible_width", wraps=argparse_color_formatter._visible_width
+        )
+        add_patch = mock.patch.object(argparse.HelpFormatter, "add_argument", autospec=True)
+        wrap_patch = mock.patch.object(ColorTextWrapper, "_wrap_measured_chunks", autospec=True)
+        with (
+            split_patch as split_chunks,
+            invocation_patch as format_invocation,
+            width_patch as visible_width,
+            add_patch as add_argument,
+            wrap_patch as wrap_chunks,
+        ):
+            layout.format_help(38)
+        split_chunks.assert_not_called()
+        format_invocation.assert_not_called()
+        add_argument.assert_not_called()
+        wrap_chunks.assert_not_called()
+        # only the usage prefix and prog are measured again
+        self.assertLessEqual(visible_width.call_count, 2)
+
+    def test_made_by_parser(self):
+        class WideHelpParser(argparse.ArgumentParser):
+            def _get_formatter(self):
+                return self.formatter_class(prog=self.prog, max_help_position=40)
+
+        parser = WideHelpParser(prog="tool", formatter_class=ColorHelpFormatter)
+        parser.add_argument("--medium-length-option", metavar="N", help="on the line of its option " * 3)
+        parser.add_argument("-s", help="short")
+        layout = argparse_color_formatter.HelpLayout(parser)
+        for width in (78, 38, 118):
+            with self.subTest(width=width), mock.patch.dict(os.environ, {"COLUMNS": str(width + 2)}):
+                self.assertEqual(layout.format_help(width), parser.format_help())
+        self.assertIn("  --medium-length-option N  on the line", layout.format_help(118))
+
+    def test_clear(self):
+        parser = plain_parser(ColorHelpFormatter)
+        layout = argparse_color_formatter.HelpLayout(parser)
+        layout.format_help(78)
+        parser._actions[1].help = "changed help"
+        self.assertNotIn("changed help", layout.format_help(78))
+        layout.clear()
+        self.assertIn("changed help", layout.format_help(78))
+
+    def test_other_formatters(self):
+        parser = plain_parser(argparse.HelpFormatter)
+        with mock.patch.dict(os.environ, {"COLUMNS": "60"}):
+            self.assertEqual(argparse_color_formatter.HelpLayout(parser).format_help(58), parser.format_help())
+        layout = argparse_color_formatter.HelpLayout(parser, formatter_class=ColorHelpFormatter)
+        with mock.patch.dict(os.environ, {"COLUMNS": "60"}):
+            self.assertEqual(layout.format_help(58), plain_parser(ColorHelpFormatter).format_help())
+
+
+class CutDefaultsHelpFormatter(ColorArgumentDefaultsHelpFormatter):
+    max_default_width = 40
+
+
+class TestCutDefaults(TestCase):
+    def defaults_parser(self, formatter_class, **defaults):
+        parser = argparse.ArgumentParser(prog="tool", formatter_class=formatter_class)
+        for name, default in defaults.items():
+            parser.add_argument("--" + name, default=default, help="the " + name)
+        return parser
+
+    def test_short_defaults_unchanged(self):
+        defaults = {
+            "items": [1, "two", (3,)],
+            "mapping": {"a": None, "b": frozenset()},
+            "empty": set(),
+            "text": "short",
+            "number": 1.5,
+            "function": len,
+            "colored": color("red", fg="red"),
+        }
+        with mock.patch.dict(os.environ, {"COLUMNS": "80"}):
+            self.assertEqual(
+                self.defaults_parser(CutDefaultsHelpFormatter, **defaults).format_help(),
+                self.defaults_parser(argparse.ArgumentDefaultsHelpFormatter, **defaults).format_help(),
+            )
+
+    def test_cut_to_max_default_width(self):
+        placeholder = CutDefaultsHelpFormatter.default_placeholder
+        cut = argparse_color_formatter._CutDefault
+        cases = (
+            (list(range(10**6)), "[0, 1, 2, 3, 4, 5"),
+            ({str(i): i for i in range(10**6)}, "{'0': 0, '1': 1, "),
+            ("x" * 10**6, "x" * 17),
+            (color("y" * 100, fg="red"), color("y" * 17, fg="red")),
+            (range(10**6), "range(0, 1000000)"),
+        )
+        for value, head in cases:
+            with self.subTest(head=head):
+                text = str(cut(value, 20, placeholder))
+                if head != str(value):
+                    head += placeholder
+                self.assertEqual(text, head)
+        self.assertEqual(repr(cut("x" * 10**6, 20, placeholder)), "'" + "x" * 16 + placeholder)
+
+    def test_recursive_default(self):
+        items = [1]
+        items.append(items)
+        self.assertEqual(str(argparse_color_formatter._CutDefault(items, 20, "...")), str(items))
+
+    def test_large_default_rendered_lazily(self):
+        parser = self.defaults_parser(CutDefaultsHelpFormatter, big=list(range(10**6)))
+        parser.add_argument("--unshown", default=list(range(10**6)), help=argparse.SUPPRESS)
+        parser.add_argument("--count", default=3, type=int, help="count %(default)d")
+        with mock.patch.object(argparse_color_formatter, "_iter_default_pieces", autospec=True) as pieces:
+            pieces.return_value = iter(["[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14"])
+            parser.format_help()
+        pieces.assert_called_once()
+        help_text = parser.format_help()
+        placeholder = CutDefaultsHelpFormatter.default_placeholder
+        self.assertIn("(default: [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11" + placeholder + ")", help_text)
+        self.assertIn("count 3", help_text)
+
+    def test_changed_default_rendered_again(self):
+        items = [1, 2, 3]
+        parser = self.defaults_parser(CutDefaultsHelpFormatter, items=items)
+        self.assertIn("(default: [1, 2, 3])", parser.format_help())
+        items[0] = 999
+        self.assertIn("(default: [999, 2, 3])", parser.format_help())
+
+    def test_cut_default_monochrome(self):
+        class MonochromeCutDefaults(CutDefaultsHelpFormatter):
+            color_mode = "never"
+
+        parser = self.defaults_parser(MonochromeCutDefaults, big=list(range(10**6)), word=color("y" * 100, fg="red"))
+        formatter = parser._get_formatter()
+        for action in parser._actions[1:]:
+            with self.subTest(action=action.dest):
+                help_text = formatter._expand_help(action)
+                self.assertNotIn("\x1b", help_text)
+                self.assertIn("...)", help_text)
+
+    def test_other_defaults_unchanged(self):
+        parser = argparse.ArgumentParser(prog="tool", formatter_class=CutDefaultsHelpFormatter)
+        parser.add_argument("--rate", default=Decimal("0.25"), help="rate (%(default).2f)")
+        parser.add_argument("--part", default=Fraction(1, 3), help="part %(default)s")
+        help_text = parser.format_help()
+        self.assertIn("rate (0.25)", help_text)
+        self.assertIn("part 1/3", help_text)
+
+
+class TerminalStringIO(StringIO):
+    def isatty(self):
+        return True
+
+
+def color_mode_parser(formatter_class):
+    parser = argparse.ArgumentParser(
+        prog=color("tool", fg="green"),
+        description="a description with {} in it, ".format(bold("colors")) * 6,
+        epilog=underline("the end"),
+        formatter_class=formatter_class,
+    )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--" + color("red", fg="red"), metavar=bold("COLOR"), help="pick {} ".format(bold("red")) * 8)
+    group.add_argument("--pair", metavar=(bold("A"), "B"), nargs=2, help="two values")
+    parser.add_argument("--count", type=int, default=3, help="how many, for %(prog)s")
+    parser.add_argument("positional", metavar=bold("POS"), help="a positional argument")
+    commands = parser.add_subparsers(title=bold("commands"), metavar=bold("COMMAND"))
+    commands.add_parser("run", help=color("run it", fg="blue"))
+    commands.add_parser("stop", help="stop it")
+    return parser
+
+
+class TestColorMode(TestCase):
+    maxDiff = None
+
+    def formatter_class(self, color_mode, formatter_class=ColorHelpFormatter):
+        return type("ModeFormatter", (formatter_class,), {"color_mode": color_mode})
+
+    def auto_help(self, environ, stdout):
+        environ = dict({"COLUMNS": "80", "NO_COLOR": "", "FORCE_COLOR": "", "TERM": "xterm"}, **environ)
+        with mock.patch.dict(os.environ, environ), mock.patch.object(sys, "stdout", stdout):
+            return color_mode_parser(self.formatter_class("auto")).format_help()
+
+    def test_never_matches_stripped_help(self):
+        for formatter_class in (ColorHelpFormatter, ColorArgumentDefaultsHelpFormatter):
+            for width in (40, 80, 160):
+                environ = mock.patch.dict(os.environ, {"COLUMNS": str(width)})
+                with self.subTest(formatter_class=formatter_class.__name__, width=width), environ:
+                    colored = color_mode_parser(formatter_class)
+                    monochrome = color_mode_parser(self.formatter_class("never", formatter_class))
+                    self.assertNotIn("\x1b", monochrome.format_help())
+                    self.assertEqual(monochrome.format_help(), strip_color(colored.format_help()))
+                    self.assertEqual(monochrome.format_usage(), strip_color(colored.format_usage()))
+
+    def test_plain_actions_not_copied(self):
+        parser = plain_parser(self.formatter_class("never"))
+        formatter = parser._get_formatter()
+        formatter.add_usage(parser.usage, parser._actions, parser._mutually_exclusive_groups)
+        self.assertTrue(formatter._stripped)
+        for original, stripped in formatter._stripped.items():
+            self.assertIs(original, stripped)
+
+    def test_auto(self):
+        cases = (
+            ({}, TerminalStringIO(), True),
+            ({}, StringIO(), False),
+            ({"NO_COLOR": "1"}, TerminalStringIO(), False),
+            ({"FORCE_COLOR": "1"}, StringIO(), True),
+            ({"TERM": "dumb"}, TerminalStringIO(), False),
+        )
+        for environ, stdout, colored in cases:
+            with self.subTest(environ=environ, stdout=type(stdout).__name__):
+                help_text = self.auto_help(environ, stdout)
+                self.assertEqual("\x1b" in help_text, colored)
+                self.assertEqual(strip_color(help_text), self.auto_help({"NO_COLOR": "1"}, stdout))
+
+    def test_invalid_color_mode(self):
+        with self.assertRaises(ValueError):
+            color_mode_parser(self.formatter_class("sometimes")).format_help()
+
+    def test_print_help_destination(self):
+        parser = color_mode_parser(self.formatter_class("auto"))
+        environ = {"COLUMNS": "80", "NO_COLOR": "", "FORCE_COLOR": ""}
+        with mock.patch.dict(os.environ, environ), mock.patch.object(sys, "stdout", StringIO()):
+            terminal = TerminalStringIO()
+            argparse_color_formatter.print_help(parser, terminal)
+            self.assertEqual(terminal.getvalue(), color_mode_parser(ColorHelpFormatter).format_help())
+            out = StringIO()
+            argparse_color_formatter.print_help(parser, out, render=argparse_color_formatter.iter_html)
+            self.assertIn("<span style=", out.getvalue())
+        with mock.patch.dict(os.environ, environ), mock.patch.object(sys, "stdout", TerminalStringIO()):
+            out = StringIO()
+            argparse_color_formatter.print_help(parser, out)
+            self.assertEqual(out.getvalue(), strip_color(parser.format_help()))
+
+    def test_help_cache_keeps_modes_apart(self):
+        formatter_class = type("CachedFormatter", (self.formatter_class("auto"),), {"help_cache": HelpCache()})
+        parser = color_mode_parser(formatter_class)
+        environ = {"COLUMNS": "80", "FORCE_COLOR": "1"}
+        with mock.patch.dict(os.environ, dict(environ, NO_COLOR="")):
+            colored = parser.format_help()
+        with mock.patch.dict(os.environ, dict(environ, NO_COLOR="1")):
+            monochrome = parser.format_help()
+        self.assertIn("\x1b", colored)
+        self.assertEqual(monochrome, strip_color(colored))
+
+
+def streamed_help(parser):
+    out = StringIO()
+    argparse_color_formatter.print_help(parser, out)
+    return out.getvalue()
+
+
+class TestStreamingHelp(TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        self.environ = mock.patch.dict(os.environ, {"COLUMNS": "80"})
+        self.environ.start()
+        self.addCleanup(self.environ.stop)
+
+    def test_streamed_help_matches_format_help(self):
+        parsers = (
+            plain_parser(ColorHelpFormatter),
+            plain_parser(ColorArgumentDefaultsHelpFormatter),
+            argparse.ArgumentParser(prog="tool", add_help=False, formatter_class=ColorHelpFormatter),
+            argparse.ArgumentParser(prog="tool", usage=argparse.SUPPRESS, formatter_class=ColorHelpFormatter),
+        )
+        for parser in parsers:
+            with self.subTest(formatter_class=parser.formatter_class.__name__, usage=parser.usage):
+                self.assertEqual(streamed_help(parser), parser.format_help())
+        for columns in ("42", "80", "160"):
+            with self.subTest(columns=columns), mock.patch.dict(os.environ, {"COLUMNS": columns}):
+                parser = argparse.ArgumentParser(prog="tool", formatter_class=ColorHelpFormatter)
+                parser.add_argument("--name", metavar=bold("NAME"), help="the {} to use".format(underline("name")))
+                self.assertEqual(streamed_help(parser), parser.format_help())
+
+    def test_lines_written_before_actions_are_formatted(self):
+        parser = plain_parser(ColorHelpFormatter)
+        formatter = parser._get_formatter()
+        argparse_color_formatter._add_parser_help(parser, formatter)
+        with mock.patch.object(
+            ColorHelpFormatter, "_iter_action_parts", autospec=True, side_effect=ColorHelpFormatter._iter_action_parts
+        ) as iter_action_parts:
+            lines = formatter.iter_help()
+            self.assertTrue(next(lines).startswith("usage: plain-tool"))
+            iter_action_parts.assert_not_called()
+            rest = list(lines)
+        self.assertEqual(len(rest), len(parser.format_help().splitlines()) - 1)
+
+    def test_overridden_format_action_is_used(self):
+        class UpperHelpFormatter(ColorHelpFormatter):
+            def _format_action(self, action):
+                return super()._format_action(action).upper()
+
+        parser = plain_parser(UpperHelpFormatter)
+        self.assertEqual(streamed_help(parser), parser.format_help())
+        self.assertIn("  --OPTION-0 VALUE", streamed_help(parser))
+
+    def test_cached_formatter(self):
+        class CachedColorHelpFormatter(ColorHelpFormatter):
+            help_cache = HelpCache()
+
+        parser = plain_parser(CachedColorHelpFormatter)
+        self.assertEqual(streamed_help(parser), plain_parser(ColorHelpFormatter).format_help())
+
+    def test_other_formatters_fall_back_to_print_help(self):
+        parser = plain_parser(argparse.HelpFormatter)
+        self.assertEqual(streamed_help(parser), parser.format_help())
+
+    def test_no_stdout(self):
+        with mock.patch.object(sys, "stdout", None):
+            argparse_color_formatter.print_help(plain_parser(ColorHelpFormatter))
+
+
+class TestMarkupRenderers(TestCase):
+    maxDiff = None
+
+    def test_html_spans(self):
+        lines = [
+            color("usage:", fg="red", style="bold") + " tool <name> & " + color("NAME", fg=208, bg=(1, 2, 3)) + "\n"
+        ]
+        self.assertEqual(
+            "".join(argparse_color_formatter.iter_html(lines)),
+            "<pre>\n"
+            '<span style="font-weight:bold;color:#cd0000">usage:</span> tool &lt;name&gt; &amp; '
+            '<span style="color:#ff8700;background-color:#010203">NAME</span>\n'
+            "</pre>\n",
+        )
+
+    def test_style_carried_across_lines(self):
+        lines = ["\x1b[1mbold\n", "still \x1b[3mbold\x1b[22m italic\x1b[0m\n", "plain\n"]
+        self.assertEqual(
+            list(argparse_color_formatter.iter_html(lines)),
+            [
+                "<pre>\n",
+                '<span style="font-weight:bold">bold</span>\n',
+                '<span style="font-weight:bold">still </span>'
+                '<span style="font-weight:bold;font-style:italic">bold</span>'
+                '<span style="font-style:italic"> italic</span>\n',
+                "plain\n",
+                "</pre>\n",
+            ],
+        )
+
+    def test_hyperlinks(self):
+        link = "\x1b]8;;https://example.com/?a=1&b=2\x1b\\docs\x1b]8;;\x1b\\"
+        self.assertEqual(
+            list(argparse_color_formatter.iter_markdown(["see " + bold(link) + "\n"]))[1],
+            'see <a href="https://example.com/?a=1&amp;b=2"><b>docs</b></a>\n',
+        )
+
+    def test_markdown_drops_colors(self):
+        lines = [color("a", fg="red") + " " + color("b", fg="blue", style="underline") + "\n"]
+        self.assertEqual(list(argparse_color_formatter.iter_markdown(lines))[1], "a <ins>b</ins>\n")
+
+    def test_text_lines_up_with_terminal_help(self):
+        with mock.patch.dict(os.environ, {"COLUMNS": "60"}):
+            parser = argparse.ArgumentParser(prog=color("tool", fg="green"), formatter_class=ColorHelpFormatter)
+            parser.add_argument("--name", metavar=bold("NAME"), help=rainbow_text("the name to use " * 8))
+            parser.add_argument("items", nargs="*", help="the <items> & things, " + underline("in order"))
+            help_text = parser.format_help()
+        for render in (argparse_color_formatter.iter_html, argparse_color_formatter.iter_markdown):
+            with self.subTest(render=render.__name__):
+                markup = "".join(render(help_text.splitlines(True)))
+                self.assertEqual(html.unescape(re.sub("<[^>]*>", "", markup)), "\n" + strip_color(help_text) + "\n")
+
+    def test_print_help_render(self):
+        with mock.patch.dict(os.environ, {"COLUMNS": "80"}):
+            parser = plain_parser(ColorHelpFormatter)
+            out = StringIO()
+            argparse_color_formatter.print_help(parser, out, render=argparse_color_formatter.iter_html)
+            expected = "".join(argparse_color_formatter.iter_html([parser.format_help()]))
+        self.assertEqual(out.getvalue(), expected)
+
+    def test_print_help_render_other_formatters(self):
+        parser = plain_parser(argparse.HelpFormatter)
+        out = StringIO()
+        argparse_color_formatter.print_help(parser, out, render=argparse_color_formatter.iter_markdown)
+        self.assertEqual(out.getvalue(), "<pre>\n" + html.escape(parser.format_help(), quote=False) + "</pre>\n")
+
+
+def export_parser():
+    parser = argparse.ArgumentParser(prog="tool", description="A tool with subcommands.")
+    parser.add_argument("--verbose", action="store_true", help="say {}".format(bold("more")))
+    commands = parser.add_subparsers(dest="command")
+    build = commands.add_parser("build", aliases=["b"], help="build things")
+    build.add_argument("target", help="what to build")
+    build_commands = build.add_subparsers(dest="build_command")
+    build_commands.add_parser("all", help="build everything")
+    commands.add_parser("a/b", help="a name with a slash")
+    return parser
+
+
+class TestExportHelp(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def read_tree(self, root):
+        tree = {}
+        for directory, _, names in os.walk(root):
+            for name in names:
+                path = os.path.join(directory, name)
+                with open(path, encoding="utf-8") as help_file:
+                    tree[os.path.relpath(path, root).replace(os.sep, "/")] = help_file.read()
+        return tree
+
+    def test_directory(self):
+        records = export_help(export_parser, self.directory.name, widths=(40, 80), processes=1)
+        self.assertEqual(
+            [(record["path"], record["width"], record["file"]) for record in records],
+            [
+                ((), 40, "40.txt"),
+                ((), 80, "80.txt"),
+                (("build",), 40, "40/build.txt"),
+                (("build",), 80, "80/build.txt"),
+                (("build", "all"), 40, "40/build/all.txt"),
+                (("build", "all"), 80, "80/build/all.txt"),
+                (("a/b",), 40, "40/a%2Fb.txt"),
+                (("a/b",), 80, "80/a%2Fb.txt"),
+            ],
+        )
+        self.assertEqual(records[4]["prog"], "tool build target all")
+        for record in records:
+            self.assertGreaterEqual(record["seconds"], 0)
+        tree = self.read_tree(self.directory.name)
+        self.assertEqual(sorted(tree), sorted(record["file"] for record in records))
+        # formatters leave 2 columns of the terminal free
+        with mock.patch.dict(os.environ, {"COLUMNS": "42"}):
+            parser = export_parser()
+            parser.formatter_class = ColorHelpFormatter
+            self.assertEqual(tree["40.txt"], parser.format_help())
+
+    def test_process_pool_matches(self):
+        in_process = os.path.join(self.directory.name, "in-process")
+        pooled = os.path.join(self.directory.name, "pooled")
+        export_help(export_parser, in_process, widths=(40, 80), processes=1)
+        records = export_help(export_parser, pooled, widths=(40, 80), formatter_class=ColorHelpFormatter, processes=2)
+        self.assertEqual(len(records), 8)
+        self.assertEqual(self.read_tree(in_process), self.read_tree(pooled))
+
+    def test_zip_is_deterministic(self):
+        archives = []
+        for name in ("first.zip", "second.zip"):
+            archive = os.path.join(self.directory.name, name)
+            export_help(export_parser, archive, formatter_class=ColorArgumentDefaultsHelpFormatter, processes=1)
+            with open(archive, "rb") as archive_file:
+                archives.append(archive_file.read())
+        self.assertEqual(archives[0], archives[1])
+        with zipfile.ZipFile(os.path.join(self.directory.name, "first.zip")) as archive:
+            self.assertEqual(archive.namelist(), ["80.txt", "80/build.txt", "80/build/all.txt", "80/a%2Fb.txt"])
+            for info in archive.infolist():
+                self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+
+    def test_shared_subparser_exported_once(self):
+        def subparsers_action(parser):
+            return next(action for action in parser._actions if isinstance(action, argparse._SubParsersAction))
+
+        parser = export_parser()
+        commands = subparsers_action(parser)
+        build_all = subparsers_action(commands.choices["build"]).choices["all"]
+        commands.choices["a/b"].add_subparsers().choices["all"] = build_all
+        paths = [path for path, _ in argparse_color_formatter._iter_subparsers(parser)]
+        self.assertEqual(paths, [(), ("build",), ("build", "all"), ("a/b",)])
+
+
+class TestFormattingProfile(TestCase):
+    def test_stages_counted(self):
+        parser = plain_parser(ColorHelpFormatter)
+        parser.add_argument("--colored", help=bold("colored") + " help")
+        with mock.patch.dict(os.environ, {"COLUMNS": "80"}), FormattingProfile() as profile:
+            parser.format_help()
+        summary = profile.summary()
+        self.assertEqual(
+            list(summary),
+            list(FormattingProfile.formatter_stages) + ["_wrap_measured_chunks", "_visible_width", "_chunk_width"],
+        )
+        self.assertEqual(summary["_format_usage"]["calls"], 1)
+        # 10 options, --colored, -h, the positional, and the subparsers action, which formats its commands
+        self.assertEqual(summary["_format_action"]["calls"], 14)
+        self.assertEqual(summary["_fill_text"]["calls"], 2)
+        self.assertEqual(summary["_wrap_measured_chunks"]["calls"], summary["_split_lines"]["calls"] + 2)
+        self.assertGreater(summary["_visible_width"]["calls"], 0)
+        self.assertGreater(summary["_chunk_width"]["calls"], 0)
+        for stage in summary.values():
+            self.assertGreaterEqual(stage["seconds"], 0)
+        self.assertGreaterEqual(summary["_format_action"]["seconds"], summary["_split_lines"]["seconds"])
+
+    def test_originals_restored(self):
+        stages = [
+            (ColorHelpFormatterMixin, "_format_action"),
+            (ColorHelpFormatterMixin, "_expand_help"),
+            (argparse_color_formatter.ColorRawTextHelpFormatter, "_split_lines"),
+            (ColorTextWrapper, "_wrap_measured_chunks"),
+            (argparse_color_formatter, "_visible_width"),
+            (argparse_color_formatter, "_chunk_width"),
+        ]
+        originals = [vars(owner)[name] for owner, name in stages]
+        with FormattingProfile():
+            for (owner, name), original in zip(stages, originals):
+                self.assertIsNot(vars(owner)[name], original)
+        self.assertEqual([vars(owner)[name] for owner, name in stages], originals)
+
+    def test_one_active_at_a_time(self):
+        original = argparse_color_formatter._visible_width
+        first, second = FormattingProfile(), FormattingProfile()
+        first.__enter__()
+        try:
+            self.assertRaisesRegex(RuntimeError, "already active", second.__enter__)
+        finally:
+            first.__exit__(None, None, None)
+        self.assertIs(argparse_color_formatter._visible_width, original)
+        with second:
+            self.assertIsNot(argparse_color_formatter._visible_width, original)
+        self.assertIs(argparse_color_formatter._visible_width, original)
+
+    def test_subclasses_of_subclasses_profiled(self):
+        class SplitLinesFormatter(ColorHelpFormatter):
+            def _split_lines(self, text, width):
+                return super()._split_lines(text.upper(), width)
+
+        with FormattingProfile() as profile:
+            plain_parser(ColorHelpFormatter).format_help()
+        split_lines_calls = profile.summary()["_split_lines"]["calls"]
+        with FormattingProfile(actions=True) as profile:
+            plain_parser(SplitLinesFormatter).format_help()
+        # each help is split by the subclass, then by the mixin
+        self.assertEqual(profile.summary()["_split_lines"]["calls"], 2 * split_lines_calls)
+        self.assertTrue(all(record["lines"] for record in profile.action_report() if record["action"] != "COMMAND"))
+
+    def test_threads_timed_separately(self):
+        profile = FormattingProfile()
+        started = Event()
+        release = Event()
+
+        def blocked(text):
+            started.set()
+            release.wait(10)
+            return 0
+
+        def slow(text):
+            time.sleep(0.01)
+            return 0
+
+        thread = Thread(target=profile._profiled(blocked, "_chunk_width"), args=("text",))
+        thread.start()
+        self.assertTrue(started.wait(10))
+        try:
+            # another thread inside the same stage doesn't stop this one being timed
+            profile._profiled(slow, "_chunk_width")("text")
+            self.assertGreaterEqual(profile.summary()["_chunk_width"]["seconds"], 0.01)
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(profile.summary()["_chunk_width"]["calls"], 2)
+
+    def test_raw_formatters_counted(self):
+        parser = plain_parser(argparse_color_formatter.ColorRawDescriptionHelpFormatter)
+        with FormattingProfile() as profile:
+            parser.format_help()
+        self.assertEqual(profile.summary()["_fill_text"]["calls"], 2)
+
+    def test_action_report(self):
+        parser = plain_parser(ColorArgumentDefaultsHelpFormatter)
+        parser.add_argument("--huge", default="x" * 10, help=" ".join([bold("huge")] * 2000) + " %(default)s")
+        with mock.patch.dict(os.environ, {"COLUMNS": "80"}):
+            with FormattingProfile(actions=True) as profile:
+                parser.format_help()
+            help_lines = parser.format_help().split("\n  --huge HUGE ")[1].split("\n\n")[0].splitlines()
+        report = profile.action_report()
+        self.assertEqual(report[0]["action"], "--huge HUGE")
+        self.assertEqual(report[0]["renders"], 1)
+        self.assertEqual(report[0]["lines"], len(help_lines))
+        # 2000 words and the default, and the spaces between them
+        self.assertEqual(report[0]["chunks"], 2 * 2001 - 1)
+        self.assertGreater(report[0]["expand_help_seconds"], 0)
+        self.assertLessEqual(report[0]["expand_help_seconds"], report[0]["seconds"])
+        self.assertEqual(
+            [record["seconds"] for record in report], sorted([record["seconds"] for record in report], reverse=True)
+        )
+        # the subcommands are recorded apart from the subparsers action
+        self.assertEqual(
+            {"first", "second", "third"} & {record["action"].strip() for record in report}, {"first", "second", "third"}
+        )
+        self.assertEqual(profile.action_report("lines")[0]["action"], "--huge HUGE")
+        self.assertEqual(json.loads(profile.dump_action_report())[0]["action"], "--huge HUGE")
+
+    def test_action_report_raw_text(self):
+        parser = argparse.ArgumentParser(
+            prog="tool", formatter_class=argparse_color_formatter.ColorRawTextHelpFormatter
+        )
+        parser.add_argument("--raw", help="kept\nas   it is")
+        with FormattingProfile(actions=True) as profile:
+            parser.format_help()
+        record = [record for record in profile.action_report() if record["action"] == "--raw RAW"][0]
+        self.assertEqual((record["chunks"], record["lines"]), (0, 1))
+
+    def test_action_report_when_streaming(self):
+        parser = plain_parser(ColorHelpFormatter)
+        with FormattingProfile(actions=True) as profile:
+            argparse_color_formatter.print_help(parser, StringIO())
+        # 10 options, -h, the positional, and the subparsers action with 3 commands
+        self.assertEqual(len(profile.action_report()), 16)
+        self.assertEqual(ColorHelpFormatterMixin._iter_action_parts.__name__, "_iter_action_parts")
+
+    def test_dump(self):
+        parser = plain_parser(ColorHelpFormatter)
+        with FormattingProfile() as profile:
+            parser.format_usage()
+        out = StringIO()
+        profile.dump(out)
+        self.assertEqual(json.loads(out.getvalue()), json.loads(profile.dump()))
+        self.assertEqual(json.loads(profile.dump())["_format_usage"]["calls"], 1)
+
+
+class TestStyledStr(TestCase):
+    def test_width(self):
+        self.assertEqual(StyledStr(bold("bold")).width, 4)
+        self.assertEqual(StyledStr("wrong", width=3).width, 3)
+        self.assertEqual(styled("--output", 1, 31), "\x1b[1;31m--output\x1b[0m")
+        self.assertEqual(styled("--output", 1, 31).width, 8)
+        self.assertEqual(styled(styled("x", 1), 31).width, 1)
+
+    def test_operations_keep_width(self):
+        name = styled("name", 1)
+        self.assertIsInstance(name + " = ", StyledStr)
+        self.assertEqual((name + " = ").width, 7)
+        self.assertEqual(("-- " + name).width, 7)
+        self.assertEqual((name + bold("x")).width, 5)
+        joined = StyledStr(", ").join([name, "plain", bold("x")])
+        self.assertEqual(joined, name + ", plain, " + bold("x"))
+        self.assertEqual(joined.width, 4 + 2 + 5 + 2 + 1)
+        self.assertEqual(StyledStr("plain text")[2:7].width, 5)
+        self.assertEqual(StyledStr(bold("bold") + " text")[:-5].width, 4)
+        self.assertEqual(StyledStr("%s: {}") % name, name + ": {}")
+        self.assertEqual((StyledStr("%s: {}") % name).format("value").width, 11)
+
+    def test_stored_width_trusted(self):
+        text = StyledStr(bold("bold"), width=4)
+        with mock.patch.object(argparse_color_formatter, "_escape_matcher_for") as matcher_for:
+            self.assertEqual(argparse_color_formatter._visible_width(text), 4)
+            self.assertEqual(argparse_color_formatter.color_aware_pad(text, 6), bold("bold") + "  ")
+            self.assertEqual(ColorTextWrapper(width=10).wrap(text + " text"), [bold("bold") + " text"])
+        matcher_for.assert_not_called()
+
+    def test_wrapper_fast_path_matches_wrap(self):
+        texts = [
+            styled("short", 1) + " help",
+            styled("a longer help text", 1) + " that wraps",
+            StyledStr(" x\ty "),
+            StyledStr("a\x1b[0m \x1b[0mx.ccc-dd \x1b[1m"),
+            StyledStr("ends with a reset " + bold("")),
+        ]
+        for text in texts:
+            for wrapper in (ColorTextWrapper(width=20), ColorTextWrapper(width=20, drop_whitespace=False)):
+                with self.subTest(text=text):
+                    self.assertEqual(wrapper.wrap(text), wrapper.wrap(str(text)))
+
+    def test_escapes_with_indent_wider_than_width(self):
+        wrapper = ColorTextWrapper(width=2, initial_indent="   ")
+        self.assertEqual(wrapper.wrap("\x1b[31m"), [])
+        self.assertEqual(wrapper.wrap(StyledStr("\x1b[31m")), [])
+
+    def test_formatter_trusts_widths(self):
+        def styled_parser():
+            parser = argparse.ArgumentParser(prog="tool", formatter_class=ColorHelpFormatter)
+            parser.add_argument("--name", metavar=styled("NAME", 4), help=styled("the name", 32) + " to use")
+            parser.add_argument("--plain", help="plain help")
+            return parser
+
+        with mock.patch.dict(os.environ, {"COLUMNS": "80"}):
+            expected = styled_parser().format_help()
+            parser = styled_parser()
+            argparse_color_formatter.width_cache.clear()
+            with mock.patch.object(
+                argparse_color_formatter,
+                "_escape_matcher_for",
+                wraps=argparse_color_formatter._escape_matcher_for,
+            ) as matcher_for:
+                self.assertEqual(parser.format_help(), expected)
+        # only the usage part of --name, composed by argparse, is measured
+        self.assertEqual(matcher_for.call_count, 1)
+        self.assertIn("  --name {}    {} to use\n".format(styled("NAME", 4), styled("the name", 32)), expected)
+
+    def test_pickle(self):
+        text = pickle.loads(pickle.dumps(styled("name", 1)))
+        self.assertEqual((text, text.width), (styled("name", 1), 4))
+
+
+class TestWidthCache(TestCase):
+    def setUp(self):
+        self.width_cache = WidthCache(maxsize=2)
+        patcher = mock.patch.object(argparse_color_formatter, "width_cache", self.width_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stats(self):
+        visible_width = argparse_color_formatter._visible_width
+        self.assertEqual(visible_width(bold("one")), 3)
+        self.assertEqual(visible_width(bold("one")), 3)
+        self.assertEqual(visible_width("plain"), 5)
+        self.assertEqual(visible_width(bold("three")), 5)
+        self.assertEqual(visible_width(bold("four")), 4)
+        self.assertEqual(self.width_cache.stats(), {"hits": 1, "misses": 3, "evictions": 1, "size": 2, "maxsize": 2})
+        self.assertIsNone(self.width_cache.get(bold("three")))
+        self.width_cache.resize(1)
+        self.assertEqual(len(self.width_cache), 1)
+        self.assertEqual(self.width_cache.stats()["evictions"], 2)
+        self.width_cache.clear()
+        self.assertEqual(self.width_cache.stats(), {"hits": 0, "misses": 0, "evictions": 0, "size": 0, "maxsize": 1})
+        self.assertRaisesRegex(ValueError, r"invalid maxsize 0 \(must be > 0\)", self.width_cache.resize, 0)
+
+    def test_repeated_renders_hit(self):
+        self.width_cache.resize(1024)
+        parser = argparse.ArgumentParser(prog=bold("tool"), formatter_class=ColorHelpFormatter)
+        parser.add_argument("--name", metavar=bold("NAME"), help="the {} to use".format(underline("name")))
+        parser.format_help()
+        misses = self.width_cache.stats()["misses"]
+        parser.format_help()
+        self.assertEqual(self.width_cache.stats()["misses"], misses)
+        self.assertEqual(self.width_cache.get(bold("tool")), 4)
+
+    def test_chunks_not_cached(self):
+        parser = argparse.ArgumentParser(prog="tool", formatter_class=ColorHelpFormatter)
+        for i in range(10):
+            parser.add_argument("--name-%d" % i, help=" ".join(bold("word%d" % (i * 10 + j)) for j in range(10)))
+        parser.format_help()
+        self.assertEqual(self.width_cache.stats()["misses"], 0)
+        self.assertEqual(len(self.width_cache), 0)
+
+    def test_threads(self):
+        texts = [bold("x" * i) for i in range(50)]
+
+        def measure():
+            for _ in range(20):
+                for i, text in enumerate(texts):
+                    self.assertEqual(argparse_color_formatter._visible_width(text), i)
+
+        threads = [Thread(target=measure) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.width_cache), 2)
+
+
+class TestSharedCache(TestCase):
+    def test_stripes(self):
+        self.assertEqual(len(HelpCache(maxsize=4)._stripes), 1)
+        cache = WidthCache(maxsize=1030)
+        self.assertEqual(len(cache._stripes), 16)
+        self.assertEqual(cache.maxsize, 1030)
+        self.assertEqual([stripe.maxsize for stripe in cache._stripes], [65] * 6 + [64] * 10)
+        cache.resize(100)
+        self.assertEqual(cache.maxsize, 100)
+        for i in range(1000):
+            cache.set(i, i)
+        self.assertLessEqual(len(cache), 100)
+        self.assertEqual(cache.stats()["evictions"], 1000 - len(cache))
+
+    def test_reads_take_no_lock(self):
+        cache = WidthCache(maxsize=1024)
+        cache.set("key", 3)
+        for stripe in cache._stripes:
+            stripe.lock.acquire()
+        try:
+            reader = Thread(target=cache.get, args=("key",))
+            reader.start()
+            reader.join(timeout=5)
+            self.assertFalse(reader.is_alive())
+        finally:
+            for stripe in cache._stripes:
+                stripe.lock.release()
+
+    def test_concurrent_renders(self):
+        class SharedCacheHelpFormatter(ColorHelpFormatter):
+            help_cache = HelpCache(maxsize=8)
+
+        parsers = [plain_parser(SharedCacheHelpFormatter) for _ in range(16)]
+        for i, parser in enumerate(parsers):
+            parser.prog = bold("tool-%d" % i)
+        with mock.patch.dict(os.environ, {"COLUMNS": "80"}):
+            expected = [parser.format_help() for parser in parsers]
+            errors = []
+
+            def render():
+                try:
+                    for _ in range(10):
+                        for parser, help_text in zip(parsers, expected):
+                            if parser.format_help() != help_text:
+                                errors.append(parser.prog)
+                except Exception as error:  # pragma: no cover
+                    errors.append(error)
+
+            threads = [Thread(target=render) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(SharedCacheHelpFormatter.help_cache), 8)
+
+
+class TestEscapeScanning(TestCase):
+    def test_sgr_width_and_spans(self):
+        text = "a" + bold("bc") + "d"
+        self.assertEqual(argparse_color_formatter._visible_width(text), 4)
+        spans = argparse_color_formatter._escape_spans(text)
+        self.assertEqual([text[start:end] for start, end in spans], ["\x1b[1m", "\x1b[0m"])
+        self.assertEqual(list(argparse_color_formatter._escape_spans("plain")), [])
+
+    def test_other_csi_sequences(self):
+        self.assertEqual(argparse_color_formatter._visible_width("\x1b[2Kab\x1b[3Ccd\x1b[?25l"), 4)
+
+    def test_osc8_hyperlinks(self):
+        for terminator in ("\x1b\\", "\x07"):
+            link = "\x1b]8;;https://example.com/docs{0}docs\x1b]8;;{0}".format(terminator)
+            self.assertEqual(argparse_color_formatter._visible_width(link), 4)
+            self.assertEqual(argparse_color_formatter._visible_width("see " + link), 8)
+            text = "see " + link
+            self.assertEqual(
+                [text[start:end] for start, end in argparse_color_formatter._escape_spans(text)],
+                ["\x1b]8;;https://example.com/docs" + terminator, "\x1b]8;;" + terminator],
+            )
+
+    def test_osc_terminators_mixed(self):
+        st_link = "\x1b]8;;https://example.com\x1b\\docs\x1b]8;;\x1b\\"
+        bel_link = "\x1b]8;;https://example.com\x07docs\x1b]8;;\x07"
+        for text in (st_link + " " + bel_link, "\x1b]0;title\x07" + st_link, "\x1b]unterminated " + bold("x")):
+            with self.subTest(text=text):
+                spans = list(argparse_color_formatter._escape_spans(text))
+                matches = [match.span() for match in argparse_color_formatter._escape_matcher.finditer(text)]
+                self.assertEqual(spans, matches)
+                self.assertEqual(
+                    argparse_color_formatter._chunk_width(text),
+                    len(argparse_color_formatter._escape_matcher.sub("", text)),
+                )
+
+    def test_plain_text(self):
+        self.assertEqual(argparse_color_formatter._visible_width("plain"), 5)
+
+    def test_hyperlinked_help_wraps_on_visible_width(self):
+        link = "\x1b]8;;https://example.com/a/very/long/url\x1b\\docs\x1b]8;;\x1b\\"
+        ctw = ColorTextWrapper(width=20)
+        lines = ctw.wrap("read the {} for more details".format(link))
+        self.assertEqual(lines, ["read the {} for".format(link), "more details"])
+
+    def test_zero_or_more_nargs(self):
+        parser = argparse.ArgumentParser(prog="prog", formatter_class=ColorHelpFormatter)
+        parser.add_argument("--items", nargs="*", metavar=bold("ITEM"))
+        parser.add_argument("--pairs", nargs="*", metavar=("KEY", "VALUE"))
+        self.assertIn(
+            "usage: prog [-h] [--items [{0} ...]] [--pairs [KEY [VALUE ...]]]\n".format(bold("ITEM")),
+            parser.format_usage(),
+        )
+
+
 class TestColorTextWrapper(TestCase):
     def test_bad_width_error(self):
         ctw = ColorTextWrapper(width=-1)
@@ -663,6 +2058,96 @@ class TestColorTextWrapper(TestCase):
         ctw = ColorTextWrapper(width=5, max_lines=2, placeholder="****")
         self.assertEqual(ctw.wrap("0123456789 " * 2), ["01234", "****"])
 
+    def test_max_lines_stops_measuring(self):
+        ctw = ColorTextWrapper(width=20, max_lines=1, placeholder=" ...")
+        text = " ".join(rainbow_text(word) for word in ["only", "the", "first", "words", "are", "measured"] * 500)
+        with mock.patch.object(
+            argparse_color_formatter, "_visible_width", wraps=argparse_color_formatter._visible_width
+        ) as measure:
+            lines = ctw.wrap(text)
+        self.assertEqual([strip_color(line) for line in lines], ["only the first ..."])
+        self.assertLess(measure.call_count, 20)
+
+    def test_max_lines_with_endless_chunks(self):
+        ctw = ColorTextWrapper(width=12, max_lines=2)
+        chunks = argparse_color_formatter._ChunkStream(itertools.cycle([(bold("word"), 4), (" ", 1)]))
+        self.assertEqual([strip_color(line) for line in ctw._wrap_measured_chunks(chunks)], ["word word", "word [...]"])
+
+    def test_max_lines_matches_stdlib(self):
+        text = "Lines end.  Some\tmore words, then a sentence end! and some-hyphenated-words to break up. " * 4
+        for options in (
+            {},
+            {"fix_sentence_endings": True},
+            {"drop_whitespace": False},
+            {"break_on_hyphens": False},
+            {"placeholder": " ~", "initial_indent": "> "},
+        ):
+            for max_lines in (1, 2, 5, 100):
+                with self.subTest(max_lines=max_lines, **options):
+                    self.assertEqual(
+                        ColorTextWrapper(width=17, max_lines=max_lines, **options).wrap(text),
+                        TextWrapper(width=17, max_lines=max_lines, **options).wrap(text),
+                    )
+
+    def test_each_chunk_measured_once(self):
+        ctw = ColorTextWrapper(width=20)
+        text = " ".join(
+            rainbow_text(word) for word in ["every", "chunk", "is", "only", "measured", "a", "single", "time"]
+        )
+        chunk_count = len(ctw._split_chunks(text))
+        with mock.patch.object(
+            argparse_color_formatter, "_chunk_width", wraps=argparse_color_formatter._chunk_width
+        ) as measure:
+            lines = ctw.wrap(text)
+        self.assertEqual(measure.call_count, chunk_count)
+        self.assertEqual(
+            [strip_color(line) for line in lines],
+            ["every chunk is only", "measured a single", "time"],
+        )
+
+    def test_wrap_chunks_accepts_plain_chunks(self):
+        ctw = ColorTextWrapper(width=12)
+        chunks = ctw._split_chunks("{red} {orange} {yellow}".format(**color_names))
+        self.assertEqual(
+            [strip_color(line) for line in ctw._wrap_chunks(chunks)],
+            ["red orange", "yellow"],
+        )
+
+    def test_long_colored_word_broken_on_visible_characters(self):
+        ctw = ColorTextWrapper(width=10)
+        url = "see " + underline("https://example.com/a/long/path", fg="blue")
+        lines = ctw.wrap(url)
+        self.assertEqual(
+            [strip_color(line) for line in lines],
+            ["see https:", "//example.", "com/a/long", "/path"],
+        )
+        open_codes = "\x1b[34;4m"
+        self.assertEqual(lines[0], "see " + open_codes + "https:\x1b[0m")
+        for line in lines[1:-1]:
+            self.assertTrue(line.startswith(open_codes))
+            self.assertTrue(line.endswith("\x1b[0m"))
+        self.assertEqual(lines[-1], open_codes + "/path\x1b[0m")
+
+    def test_long_word_break_carries_hyperlink(self):
+        ctw = ColorTextWrapper(width=8, break_on_hyphens=False)
+        link = "\x1b]8;;https://example.com\x1b\\"
+        lines = ctw.wrap(link + bold("example-link") + "\x1b]8;;\x1b\\")
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0], link + "\x1b[1mexample-\x1b[0m\x1b]8;;\x1b\\")
+        self.assertEqual(lines[1], link + "\x1b[1mlink\x1b[0m\x1b]8;;\x1b\\")
+
+    def test_long_colored_word_on_hyphens(self):
+        ctw = ColorTextWrapper(width=10)
+        word = color("some-long-hyphenated-word", fg="red")
+        self.assertEqual(
+            [strip_color(line) for line in ctw.wrap("a " + word)],
+            TextWrapper(width=10).wrap("a some-long-hyphenated-word"),
+        )
+        head, tail, head_width = argparse_color_formatter._break_escaped_word(
+            "--" + color("ab-cd", fg="red"), 5, on_hyphens=True
+        )
+        self.assertEqual((head, tail, head_width), ("--\x1b[31mab-\x1b[0m", "\x1b[31mcd\x1b[0m", 5))
+
 
 if __name__ == "__main__":
     rainbow_maker_colored_metavar(None, longer_help=2)